@@ -0,0 +1,58 @@
+import os
+import numpy as np
+import torch
+from scipy.linalg import hadamard
+
+###------------------------------Cell anchors---------------------------------###
+# Every class is assigned a +1/-1 target code (cell anchor); cells are annotated with
+# the class of their closest anchor.
+
+# pairwise Hamming distances between +1/-1 anchors, computed with one matrix product
+def anchor_pairwise_distances(hash_targets):
+    hash_targets = np.asarray(hash_targets, dtype=np.float64)
+    bit = hash_targets.shape[1]
+    dists = (bit - hash_targets @ hash_targets.T) / 2
+    return dists[np.triu_indices(hash_targets.shape[0], k=1)]
+
+# generate cell anchors
+# When n_class > 2 * bit the Hadamard rows run out and the remaining anchors are random
+# balanced codes. Each of n_trials candidate sets is scored with one matrix product and the one with the largest
+# minimum (then mean) pairwise distance is kept. When a cache_dir is given the result is
+# stored there for each (n_class, bit, seed, n_trials), so later model constructions load it instead.
+def get_cell_anchors(n_class, bit, seed=0, n_trials=200, cache_dir=None):
+    H_K = hadamard(bit)
+    H_2K = np.concatenate((H_K, -H_K), 0)
+    if H_2K.shape[0] >= n_class:
+        return torch.from_numpy(H_2K[:n_class]).float()
+
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, "anchors_{}_{}_{}_{}.npy".format(n_class, bit, seed, n_trials))
+        if os.path.exists(cache_path):
+            return torch.from_numpy(np.load(cache_path)).float()
+
+    rng = np.random.default_rng(seed)
+    n_random = n_class - H_2K.shape[0]
+    best, best_score = None, None
+    for k in range(n_trials):
+        # Bernouli distribution, exactly bit // 2 entries of every random anchor are -1
+        ranks = np.argsort(rng.random((n_random, bit)), axis=1)
+        random_targets = np.where(ranks < bit // 2, -1, 1)
+        hash_targets = np.concatenate((H_2K, random_targets), 0)
+
+        # to find average/min pairwise distance
+        c = anchor_pairwise_distances(hash_targets)
+        score = (c.min(), c.mean())
+        if best_score is None or score > best_score:
+            best, best_score = hash_targets, score
+
+    # choose min(c) in the range of K/4 to K/3
+    # see in https://github.com/yuanli2333/Hadamard-Matrix-for-hashing/issues/1
+    # but it is hard when bit is  small
+    print("cell anchors: min distance = {}, mean distance = {:.2f}".format(*best_score))
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = cache_path + '.tmp{}.npy'.format(os.getpid())
+        np.save(tmp_path, best.astype(np.float32))
+        os.replace(tmp_path, cache_path)
+    return torch.from_numpy(best).float()
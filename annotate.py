@@ -0,0 +1,261 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+import scipy.sparse
+
+from bundle import load_bundle
+from hamming import pack_binaries, annotate_closest_cell_anchor
+
+###------------------------------Streaming cell annotation---------------------------------###
+# Annotates a cell-by-gene matrix with a model bundle (see bundle.py) one chunk of cells
+# at a time, so memory stays bounded by the chunk size whatever the number of cells.
+# Results are appended to raw little-endian binary files in the output directory:
+#   predictions.i32     predicted label of every cell
+#   distances.i32       Hamming distance to the closest cell anchor
+#   margins.i32         distance to the runner-up anchor minus the closest distance
+#   codes.u64           packed hash codes, n_words(bit) uint64 words per cell
+#   cells.txt           cell names, one per line
+#   meta.json           cell count, bit, label mapping and per-stage timings
+# read_annotation() maps them back as numpy arrays.
+
+
+###### Matrix readers: each yields (cell names, (n, n_genes) float32 ndarray or CSR matrix) ######
+# pandas is imported by the text readers only, so .npy/.npz annotation starts faster
+
+def read_csv_chunks(path, chunk_size):
+    # cells in rows, genes in columns, as the training CSVs
+    import pandas as pd
+    for chunk in pd.read_csv(path, index_col=0, sep=',', chunksize=chunk_size):
+        yield list(chunk.index), np.asarray(chunk, dtype=np.float32)
+
+
+def csv_genes(path):
+    import pandas as pd
+    return list(pd.read_csv(path, index_col=0, sep=',', nrows=0).columns)
+
+
+def read_mtx_chunks(path, chunk_size, genes_by_cells=True, cell_names=None):
+    ''' Stream a Matrix Market coordinate file. Entries must be grouped by cell in increasing
+    order, as written by 10x Genomics (genes in rows, cells in columns). Entries of a
+    pattern file (no value column) count as 1.
+    '''
+    import pandas as pd
+    with open(path) as f:
+        header = f.readline().lower().split()
+        if len(header) < 4 or 'coordinate' not in header:
+            raise ValueError("{} is not a coordinate Matrix Market file".format(path))
+        field = header[3]
+        if field not in ('real', 'integer', 'pattern'):
+            raise ValueError("{} has {} entries, only real, integer and pattern are supported".format(path, field))
+        if len(header) > 4 and header[4] != 'general':
+            raise ValueError("{} is {}, only general matrices are supported".format(path, header[4]))
+        line = f.readline()
+        while line.startswith('%'):
+            line = f.readline()
+        n_rows, n_cols, _ = (int(v) for v in line.split())
+        n_cells, n_genes = (n_cols, n_rows) if genes_by_cells else (n_rows, n_cols)
+        cell_axis = 1 if genes_by_cells else 0
+
+        pending = np.empty((0, 3))
+        chunk_start = 0
+        entries = pd.read_csv(f, sep=r'\s+', header=None, comment='%', chunksize=1 << 20, dtype=np.float64)
+        for block in entries:
+            block = block.to_numpy()
+            if field == 'pattern':
+                block = np.column_stack([block[:, :2], np.ones(len(block))])
+            block = np.concatenate([pending, block])
+            cells = block[:, cell_axis].astype(np.int64) - 1
+            if np.any(np.diff(cells) < 0) or (cells.size and cells[0] < chunk_start):
+                raise ValueError("{} is not sorted by cell, cannot stream it".format(path))
+            # emit every complete chunk of cells, keep the entries of the last, partial one
+            while cells.size and cells[-1] >= chunk_start + chunk_size:
+                end = np.searchsorted(cells, chunk_start + chunk_size)
+                yield _mtx_chunk(block[:end], cells[:end], chunk_start, chunk_size, n_genes, 1 - cell_axis, cell_names)
+                block, cells = block[end:], cells[end:]
+                chunk_start += chunk_size
+            pending = block
+        while chunk_start < n_cells:
+            size = min(chunk_size, n_cells - chunk_start)
+            yield _mtx_chunk(pending, pending[:, cell_axis].astype(np.int64) - 1, chunk_start, size, n_genes, 1 - cell_axis, cell_names)
+            pending = np.empty((0, 3))
+            chunk_start += size
+
+
+def _mtx_chunk(entries, cells, chunk_start, size, n_genes, gene_axis, cell_names):
+    genes = entries[:, gene_axis].astype(np.int64) - 1
+    matrix = scipy.sparse.csr_matrix((entries[:, 2].astype(np.float32), (cells - chunk_start, genes)),
+                                     shape=(size, n_genes))
+    names = cell_names[chunk_start:chunk_start + size] if cell_names is not None else \
+        [str(i) for i in range(chunk_start, chunk_start + size)]
+    return names, matrix
+
+
+def read_array_chunks(path, chunk_size, cell_names=None):
+    # .npy (memory-mapped, dense) or .npz saved by scipy.sparse.save_npz
+    if path.endswith('.npz'):
+        data = scipy.sparse.load_npz(path).tocsr()
+    else:
+        data = np.load(path, mmap_mode='r')
+    for start in range(0, data.shape[0], chunk_size):
+        end = min(start + chunk_size, data.shape[0])
+        names = cell_names[start:end] if cell_names is not None else [str(i) for i in range(start, end)]
+        chunk = data[start:end]
+        yield names, chunk if scipy.sparse.issparse(chunk) else np.asarray(chunk, dtype=np.float32)
+
+
+def read_names(path):
+    # one name per line, first tab-separated column (10x features.tsv / barcodes.tsv)
+    with open(path) as f:
+        return [line.rstrip('\n').split('\t')[0] for line in f if line.strip()]
+
+
+###### Output ######
+
+class AnnotationWriter:
+    'Appends annotation results of consecutive chunks to the output directory'
+
+    def __init__(self, output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.files = {name: open(os.path.join(output_dir, name), 'wb')
+                      for name in ('predictions.i32', 'distances.i32', 'margins.i32', 'codes.u64')}
+        self.cells_file = open(os.path.join(output_dir, 'cells.txt'), 'w')
+        self.n_cells = 0
+
+    def write(self, cell_names, labels_pred, dists, margins, packed_codes):
+        self.files['predictions.i32'].write(labels_pred.astype('<i4').tobytes())
+        self.files['distances.i32'].write(dists.astype('<i4').tobytes())
+        self.files['margins.i32'].write(margins.astype('<i4').tobytes())
+        self.files['codes.u64'].write(np.ascontiguousarray(packed_codes, dtype='<u8').tobytes())
+        self.cells_file.writelines(str(name) + '\n' for name in cell_names)
+        self.n_cells += len(labels_pred)
+
+    def close(self, meta):
+        for f in self.files.values():
+            f.close()
+        self.cells_file.close()
+        meta = dict(meta, n_cells=self.n_cells)
+        with open(os.path.join(self.output_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+
+def read_annotation(output_dir):
+    ''' Memory-map the results written by annotate().
+    Returns a dict with predictions, distances, margins, codes (packed), cells and meta.
+    '''
+    with open(os.path.join(output_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    n_cells, words = meta['n_cells'], (meta['bit'] + 63) // 64
+
+    def load(name, dtype, shape):
+        if n_cells == 0:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(os.path.join(output_dir, name), dtype=dtype, mode='r', shape=shape)
+
+    with open(os.path.join(output_dir, 'cells.txt')) as f:
+        cells = f.read().splitlines()
+    return {'predictions': load('predictions.i32', '<i4', (n_cells,)),
+            'distances': load('distances.i32', '<i4', (n_cells,)),
+            'margins': load('margins.i32', '<i4', (n_cells,)),
+            'codes': load('codes.u64', '<u8', (n_cells, words)),
+            'cells': cells,
+            'meta': meta}
+
+
+###### Pipeline ######
+
+def annotate(bundle, chunks, output_dir, alignment=None):
+    ''' Encode and annotate every chunk of (cell names, matrix), writing results as they come.
+    alignment: optional bundle.GeneAlignment reordering the input columns to the training genes
+    Returns the per-stage timings in seconds and the number of annotated cells.
+    '''
+    writer = AnnotationWriter(output_dir)
+    cell_anchors = bundle.cell_anchors
+    timings = {'read': 0., 'align': 0., 'encode': 0., 'annotate': 0., 'write': 0.}
+    start = time.time()
+    for cell_names, matrix in chunks:
+        timings['read'] += time.time() - start
+
+        start = time.time()
+        if alignment is not None:
+            matrix = alignment.apply(matrix)
+        timings['align'] += time.time() - start
+
+        start = time.time()
+        codes = bundle.forward(matrix)
+        timings['encode'] += time.time() - start
+
+        start = time.time()
+        labels_pred, dists, margins = annotate_closest_cell_anchor(codes, cell_anchors)
+        packed_codes = pack_binaries(codes)
+        timings['annotate'] += time.time() - start
+
+        start = time.time()
+        writer.write(cell_names, labels_pred, dists, margins, packed_codes)
+        timings['write'] += time.time() - start
+        start = time.time()
+    writer.close({'bit': bundle.bit,
+                  'label_mapping': bundle.label_mapping,
+                  'timings': timings})
+    return timings, writer.n_cells
+
+
+def print_summary(timings, n_cells):
+    print("-------Annotation summary---------")
+    print("  - Annotated {} cells".format(n_cells))
+    for stage, duration in timings.items():
+        speed = n_cells / duration if duration > 0 else float('inf')
+        print("  - {:<9} {:8.2f} s  {:12.0f} cells/s".format(stage, duration, speed))
+    total = sum(timings.values())
+    print("  - {:<9} {:8.2f} s  {:12.0f} cells/s".format("total", total, n_cells / total if total > 0 else float('inf')))
+
+
+def open_matrix(path, chunk_size, genes_path=None, cells_path=None, genes_by_cells=True):
+    # returns (chunk iterator, gene names or None)
+    cell_names = read_names(cells_path) if cells_path else None
+    genes = read_names(genes_path) if genes_path else None
+    if path.endswith('.csv') or path.endswith('.csv.gz'):
+        return read_csv_chunks(path, chunk_size), csv_genes(path)
+    if path.endswith('.mtx'):
+        return read_mtx_chunks(path, chunk_size, genes_by_cells, cell_names), genes
+    if path.endswith('.npz') or path.endswith('.npy'):
+        return read_array_chunks(path, chunk_size, cell_names), genes
+    raise ValueError("Unsupported input format: {}".format(path))
+
+
+def get_alignment(bundle, genes):
+    # column gather onto the training genes, None when the input already uses the training order
+    if genes is None or not bundle.genes:
+        return None
+    alignment = bundle.align(genes)
+    print("Gene alignment:", alignment.summary())
+    return None if alignment.identity else alignment
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Annotate cells with a scDeepHash model bundle")
+    parser.add_argument("bundle", type=str,
+                        help="Model bundle directory written by scDeepHash.py --export_bundle (or a .npz bundle of earlier versions)")
+    parser.add_argument("input", type=str,
+                        help="Cell-by-gene .csv, Matrix Market .mtx, dense .npy or scipy sparse .npz")
+    parser.add_argument("output_dir", type=str,
+                        help="Directory to write the annotation to")
+    parser.add_argument("--chunk_size", type=int, default=4096,
+                        help="Number of cells read and annotated at a time")
+    parser.add_argument("--genes", type=str, default='',
+                        help="Gene names of the input columns, one per line (.mtx/.npy/.npz inputs), "
+                             "aligned to the training genes of the bundle")
+    parser.add_argument("--cells", type=str, default='',
+                        help="Cell names of the input rows, one per line (.mtx/.npy/.npz inputs)")
+    parser.add_argument("--mtx_cells_by_genes", action='store_true',
+                        help="The .mtx file has cells in rows (default: genes in rows, as 10x Genomics)")
+    args = parser.parse_args()
+
+    bundle = load_bundle(args.bundle)
+    chunks, genes = open_matrix(args.input, args.chunk_size, args.genes or None, args.cells or None,
+                                genes_by_cells=not args.mtx_cells_by_genes)
+    alignment = get_alignment(bundle, genes)
+    timings, n_cells = annotate(bundle, chunks, args.output_dir, alignment)
+    print_summary(timings, n_cells)
@@ -0,0 +1,70 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+###------------------------------Startup benchmark---------------------------------###
+# Import time and peak RSS of every entry point, each measured in a fresh interpreter
+# so module caches of one measurement do not leak into the next. Run from anywhere:
+#   python benchmarks/startup.py [--repeat 3] [--output startup.json]
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# inference path first, then the training stack for comparison
+MODULES = ['hamming', 'bundle', 'annotate', 'anchors', 'hashModel', 'util', 'dataModule', 'scDeepHash']
+
+_PROBE = '''
+import json, resource, sys, time
+baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+import {module}
+duration = time.perf_counter() - start
+heavy = [name for name in ('torch', 'pytorch_lightning', 'sklearn', 'torchvision', 'rpy2', 'fairscale', 'pandas')
+         if name in sys.modules]
+print(json.dumps({{'import_seconds': duration,
+                  'baseline_rss_mb': baseline / 1024,
+                  'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  'heavy_modules': heavy}}))
+'''
+
+
+def measure_import(module, repeat=3):
+    runs = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-c', _PROBE.format(module=module)],
+                                cwd=REPO_DIR, capture_output=True, text=True)
+        if result.returncode != 0:
+            return {'error': result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'failed'}
+        runs.append(json.loads(result.stdout.strip().splitlines()[-1]))
+    # best of the repeats, the others include cold file-system caches
+    best = min(runs, key=lambda run: run['import_seconds'])
+    best['import_seconds_all'] = [run['import_seconds'] for run in runs]
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Fresh interpreters per module, the fastest one is reported")
+    parser.add_argument("--modules", type=str, nargs='*', default=MODULES,
+                        help="Modules to import")
+    parser.add_argument("--output", type=str, default='',
+                        help="Path to write the JSON report, printed when empty")
+    args = parser.parse_args()
+
+    report = {'python': sys.version.split()[0], 'modules': {}}
+    for module in args.modules:
+        report['modules'][module] = result = measure_import(module, args.repeat)
+        if 'error' in result:
+            print("{:<12} error: {}".format(module, result['error']), file=sys.stderr)
+        else:
+            print("{:<12} {:7.3f} s  {:8.1f} MB peak RSS  heavy: {}".format(
+                module, result['import_seconds'], result['peak_rss_mb'], ', '.join(result['heavy_modules']) or '-'),
+                file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
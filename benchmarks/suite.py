@@ -0,0 +1,242 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+###------------------------------Synthetic benchmark suite---------------------------------###
+# Offline CPU benchmarks on generated expression matrices and hash codes, so results are
+# comparable between versions of the code on the same machine. Every case is timed
+# `repeat` times after one warm-up run; the best and median times are reported.
+#   python benchmarks/suite.py [--quick] [--cases encoder hamming ...] [--output results.json]
+# Compare two reports with benchmarks/suite.py --compare old.json new.json.
+
+DB_SIZES = [1000, 10000, 100000, 1000000, 10000000]
+QUICK_DB_SIZES = [1000, 10000, 100000]
+
+
+def timeit(fn, repeat):
+    fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times), float(np.median(times))
+
+
+def format_params(params):
+    return ' '.join('{}={}'.format(key, value) for key, value in sorted(params.items()))
+
+
+def record(results, case, params, items, unit, fn, repeat):
+    best, median = timeit(fn, repeat)
+    result = {'case': case, 'params': params, 'best_seconds': best, 'median_seconds': median,
+              'throughput': items / best, 'unit': unit}
+    results.append(result)
+    print("{:<20} {:<64} {:10.4f} s {:14.0f} {}".format(
+        case, format_params(params), best, result['throughput'], unit), file=sys.stderr)
+    return result
+
+
+def clustered_codes(rng, n, cell_anchors, flip_rate=0.1):
+    # +1/-1 codes scattered around random anchors, with their labels
+    labels = rng.integers(0, len(cell_anchors), size=n)
+    flips = np.where(rng.random((n, cell_anchors.shape[1])) < flip_rate, -1, 1)
+    return (cell_anchors[labels] * flips).astype(np.float32), labels
+
+
+def clustered_packed_codes(rng, n, bit, n_class, flip_rate=0.1, chunk_size=1 << 20):
+    # packed codes around random anchors, generated in chunks so 10M-cell databases fit in memory
+    from hamming import pack_binaries
+    anchors = pack_binaries(rng.integers(0, 2, size=(n_class, bit)) * 2 - 1)
+    codes = np.empty((n, anchors.shape[1]), dtype=np.uint64)
+    threshold = int(flip_rate * 256)
+    for start in range(0, n, chunk_size):
+        size = min(chunk_size, n - start)
+        flips = pack_binaries(rng.integers(0, 256, size=(size, bit), dtype=np.uint8) < threshold)
+        codes[start:start + size] = anchors[rng.integers(0, n_class, size=size)] ^ flips
+    return codes
+
+
+###### Cases ######
+
+def bench_encoder(results, rng, args):
+    import torch
+    from hashModel import HashEncoder
+    torch.manual_seed(0)
+    data = rng.random((args.encoder_cells, args.n_features), dtype=np.float32)
+    for n_layers in (3, 4, 5):
+        encoder = HashEncoder(args.n_class, args.n_features, bit=args.bit, n_layers=n_layers)
+        params = {'n_layers': n_layers, 'n_features': args.n_features, 'bit': args.bit, 'cells': len(data),
+                  'batch_size': args.batch_size, 'threads': torch.get_num_threads()}
+        record(results, 'encoder_float32', params, len(data), 'cells/s',
+               lambda: list(encoder.encode(data, batch_size=args.batch_size)), args.repeat)
+        encoder.quantize()
+        record(results, 'encoder_int8', params, len(data), 'cells/s',
+               lambda: list(encoder.encode(data, batch_size=args.batch_size)), args.repeat)
+
+
+def bench_annotation(results, rng, args):
+    from anchors import get_cell_anchors
+    from hamming import annotate_closest_cell_anchor
+    for n_class in (args.n_class, 4 * args.bit):
+        cell_anchors = get_cell_anchors(n_class, args.bit, cache_dir=None, n_trials=10).numpy()
+        codes, _ = clustered_codes(rng, args.annotation_cells, cell_anchors)
+        params = {'n_class': n_class, 'bit': args.bit, 'cells': len(codes)}
+        record(results, 'anchor_annotation', params, len(codes), 'cells/s',
+               lambda: annotate_closest_cell_anchor(codes, cell_anchors), args.repeat)
+
+
+def bench_hamming(results, rng, args):
+    from hamming import calc_hamming_dist_packed, hamming_topk, rank_by_distance, MultiIndexHashing
+    for size in (QUICK_DB_SIZES if args.quick else DB_SIZES):
+        # queries and database drawn around the same anchors, as cells of the same classes
+        codes = clustered_packed_codes(np.random.default_rng(args.seed), size + args.queries, args.bit, args.n_class)
+        queries, database = codes[:args.queries], codes[args.queries:]
+        params = {'database': size, 'bit': args.bit, 'queries': len(queries)}
+
+        def distances():
+            for query in queries:
+                calc_hamming_dist_packed(query, database)
+
+        def top_k():
+            hamming_topk(queries, database, args.topk)
+
+        def full_ranking():
+            for query in queries:
+                rank_by_distance(calc_hamming_dist_packed(query, database), args.bit)
+
+        record(results, 'hamming_distance', params, len(queries) * size, 'codes/s', distances, args.repeat)
+        record(results, 'hamming_topk', dict(params, k=args.topk), len(queries), 'queries/s', top_k, args.repeat)
+        record(results, 'hamming_rank', params, len(queries), 'queries/s', full_ranking, args.repeat)
+        if size <= args.mih_max:
+            start = time.perf_counter()
+            index = MultiIndexHashing(database, args.bit)
+            build = time.perf_counter() - start
+            result = record(results, 'mih_knn', dict(params, k=args.topk), len(queries), 'queries/s',
+                            lambda: [index.knn(query, args.topk) for query in queries], args.repeat)
+            result['build_seconds'] = build
+
+
+def bench_map(results, rng, args):
+    from anchors import get_cell_anchors
+    from util import compute_MAP, compute_MAP_batched
+    cell_anchors = get_cell_anchors(args.n_class, args.bit, cache_dir=None, n_trials=10).numpy()
+    database, database_labels = clustered_codes(rng, args.map_database, cell_anchors, flip_rate=0.2)
+    query, query_labels = clustered_codes(rng, args.map_queries, cell_anchors, flip_rate=0.2)
+    onehot = np.eye(args.n_class, dtype=np.float32)
+    for topk in (args.topk, database.shape[0]):
+        params = {'database': len(database), 'queries': len(query), 'bit': args.bit, 'topk': topk}
+        record(results, 'compute_MAP', params, len(query), 'queries/s',
+               lambda: compute_MAP(database, query, onehot[database_labels], onehot[query_labels], topk), args.repeat)
+        record(results, 'compute_MAP_batched', params, len(query), 'queries/s',
+               lambda: compute_MAP_batched(database, query, database_labels, query_labels, topk), args.repeat)
+
+
+def bench_dataloader(results, rng, args):
+    import scipy.sparse
+    import torch
+    from torch.utils.data import DataLoader
+    from dataModule import CustomDataset, TensorBatchDataset, SparseCustomDataset, batch_dataloader
+    n_cells, n_genes = args.loader_cells, args.n_features
+    dense = rng.random((n_cells, n_genes), dtype=np.float32)
+    dense[rng.random((n_cells, n_genes)) > args.density] = 0
+    labels = rng.integers(0, args.n_class, size=n_cells)
+    loaders = {
+        'CustomDataset': DataLoader(CustomDataset(torch.from_numpy(dense), torch.from_numpy(labels)),
+                                    batch_size=args.batch_size, shuffle=True),
+        'TensorBatchDataset': batch_dataloader(TensorBatchDataset(dense, labels), args.batch_size, shuffle=True),
+        'SparseCustomDataset': batch_dataloader(SparseCustomDataset(scipy.sparse.csr_matrix(dense), labels),
+                                                args.batch_size, shuffle=True),
+    }
+    for name, loader in loaders.items():
+        params = {'dataset': name, 'cells': n_cells, 'genes': n_genes, 'density': args.density,
+                  'batch_size': args.batch_size}
+        record(results, 'dataloader_epoch', params, n_cells, 'cells/s', lambda: [batch for batch in loader], args.repeat)
+
+
+CASES = {'encoder': bench_encoder,
+         'annotation': bench_annotation,
+         'hamming': bench_hamming,
+         'map': bench_map,
+         'dataloader': bench_dataloader}
+
+
+def environment():
+    info = {'python': sys.version.split()[0], 'numpy': np.__version__,
+            'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count()}
+    try:
+        import torch
+        info['torch'] = torch.__version__
+        info['torch_threads'] = torch.get_num_threads()
+    except ImportError:
+        pass
+    return info
+
+
+def compare(old_path, new_path):
+    # throughput ratio new / old of every case present in both reports
+    with open(old_path) as f:
+        old = {(r['case'], json.dumps(r['params'], sort_keys=True)): r for r in json.load(f)['results']}
+    with open(new_path) as f:
+        new = json.load(f)['results']
+    for result in new:
+        key = (result['case'], json.dumps(result['params'], sort_keys=True))
+        if key in old:
+            ratio = result['throughput'] / old[key]['throughput']
+            print("{:<20} {:<64} {:6.2f}x".format(result['case'], format_params(result['params']), ratio))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", type=str, nargs='*', default=list(CASES),
+                        help="Benchmark cases to run: " + ", ".join(CASES))
+    parser.add_argument("--quick", action='store_true',
+                        help="Smaller sizes (database up to 100k cells) for a fast smoke run")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Timed runs per case, after one warm-up run")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the generated data")
+    parser.add_argument("--output", type=str, default='',
+                        help="Path to write the JSON report, printed when empty")
+    parser.add_argument("--compare", type=str, nargs=2, metavar=('OLD', 'NEW'),
+                        help="Print throughput ratios between two reports and exit")
+    # workload sizes
+    parser.add_argument("--bit", type=int, default=64)
+    parser.add_argument("--n_class", type=int, default=55)
+    parser.add_argument("--n_features", type=int, default=2000)
+    parser.add_argument("--batch_size", type=int, default=1024)
+    parser.add_argument("--encoder_cells", type=int, default=8192)
+    parser.add_argument("--annotation_cells", type=int, default=200000)
+    parser.add_argument("--queries", type=int, default=16)
+    parser.add_argument("--topk", type=int, default=100)
+    parser.add_argument("--mih_max", type=int, default=1000000,
+                        help="Largest database size indexed with multi-index hashing")
+    parser.add_argument("--map_database", type=int, default=20000)
+    parser.add_argument("--map_queries", type=int, default=500)
+    parser.add_argument("--loader_cells", type=int, default=20000)
+    parser.add_argument("--density", type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit()
+    if args.quick:
+        args.encoder_cells, args.annotation_cells = 2048, 20000
+        args.map_database, args.map_queries, args.loader_cells = 5000, 100, 5000
+
+    results = []
+    for case in args.cases:
+        CASES[case](results, np.random.default_rng(args.seed), args)
+    report = {'environment': environment(), 'args': vars(args), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,228 @@
+import json
+import os
+import shutil
+import numpy as np
+import scipy.sparse
+
+from hamming import annotate_closest_cell_anchor
+
+###------------------------------Compact model bundle---------------------------------###
+# A directory holding everything needed to annotate cells with a trained model:
+#   weight_<i>.npy, bias_<i>.npy    Linear layers of the hash layer (ReLU between them), float16 or float32
+#   cell_anchors.npy                (n_class, bit) +1/-1 anchor matrix
+#   genes.npy                       gene names in the order of the input features
+#   gene_sort_order.npy             argsort of genes, the lookup index used by GeneAlignment
+#   label_mapping.npy               class names, indexed by label
+#   meta.json                       bit, n_class, n_features, n_layers, dtype, metadata
+# There is no optimizer state and no training hyperparameter. Loading needs only numpy:
+# the forward pass is a chain of matmuls, so neither torch nor the training stack
+# (Lightning, rpy2, sklearn) is imported. Weights are memory-mapped, so loading reads only
+# the small arrays; float16 weights are converted to float32 per layer on first use, and
+# float32 bundles run straight from the memory maps. Single-file .npz bundles written by
+# earlier versions (bundle version 1) are still loaded.
+
+BUNDLE_VERSION = 2
+
+
+def _linear_layers(hash_layer):
+    # (weight, bias) of every Linear of a Linear/ReLU/Dropout stack
+    layers = []
+    for module in hash_layer:
+        name = type(module).__name__
+        if name == 'Linear' and not callable(module.weight):
+            layers.append((module.weight.detach().cpu().numpy(), module.bias.detach().cpu().numpy()))
+        elif name not in ('ReLU', 'Dropout'):
+            raise ValueError("Cannot export {} layers, export the float model".format(name))
+    return layers
+
+
+def export_bundle(model, path, genes=None, label_mapping=None, dtype='float16', metadata=None):
+    ''' Write the hash layer, anchors, gene order and label mapping of a model to a bundle directory.
+    genes: input feature names, in training order
+    label_mapping: class names, indexed by label
+    dtype: 'float16' halves the size on disk, 'float32' keeps the weights exact and needs no
+           conversion when loaded
+    '''
+    dtype = np.dtype(dtype)
+    arrays = {}
+    layers = _linear_layers(model.hash_layer)
+    for i, (weight, bias) in enumerate(layers):
+        arrays['weight_{}'.format(i)] = weight.astype(dtype)
+        arrays['bias_{}'.format(i)] = bias.astype(dtype)
+    arrays['cell_anchors'] = np.asarray(model.cell_anchors.cpu().numpy() if hasattr(model.cell_anchors, 'cpu')
+                                        else model.cell_anchors, dtype=np.int8)
+    arrays['genes'] = np.array([] if genes is None else [str(gene) for gene in genes])
+    arrays['gene_sort_order'] = np.argsort(arrays['genes'], kind='stable').astype(np.int32)
+    arrays['label_mapping'] = np.array([] if label_mapping is None else [str(name) for name in label_mapping])
+    meta = {'version': BUNDLE_VERSION,
+            'bit': int(model.bit),
+            'n_class': int(model.n_class),
+            'n_features': int(layers[0][0].shape[1]),
+            'n_layers': len(layers),
+            'dtype': dtype.name,
+            'metadata': metadata or {}}
+
+    # write next to the destination and swap it in, so readers never see a partial bundle
+    tmp_path = path.rstrip(os.sep) + '.tmp{}'.format(os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, name + '.npy'), array)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+    print("Saved model bundle to", path)
+
+
+def write_label_mapping(label_mapping, data_name, root='label_maps'):
+    # label_maps/<data_name>/label_mapping.json: {"0": class name, ...}, as read by visualize.py
+    directory = os.path.join(root, data_name)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, 'label_mapping.json')
+    with open(path, 'w') as f:
+        json.dump({str(i): str(name) for i, name in enumerate(label_mapping)}, f, indent=2)
+    return path
+
+
+def _read_bundle_arrays(path):
+    # (meta, arrays) of a bundle directory (weights memory-mapped) or of a version 1 .npz file
+    if os.path.isdir(path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        arrays = {name[:-len('.npy')]: np.load(os.path.join(path, name), mmap_mode='r', allow_pickle=False)
+                  for name in os.listdir(path) if name.endswith('.npy')}
+        return meta, arrays
+    with np.load(path, allow_pickle=False) as bundle:
+        arrays = {name: bundle[name] for name in bundle.files}
+    return json.loads(str(arrays.pop('meta'))), arrays
+
+
+class ModelBundle:
+    'Inference-only model loaded from a bundle directory (or a version 1 .npz file)'
+
+    def __init__(self, path):
+        self.meta, arrays = _read_bundle_arrays(path)
+        if self.meta['version'] > BUNDLE_VERSION:
+            raise ValueError("{} was written by a newer version (bundle version {})".format(path, self.meta['version']))
+        # stored weights, converted to float32 by layer(i) on first use
+        self._stored_layers = [(arrays['weight_{}'.format(i)], arrays['bias_{}'.format(i)])
+                               for i in range(self.meta['n_layers'])]
+        self._layers = [None] * self.meta['n_layers']
+        self.cell_anchors = np.asarray(arrays['cell_anchors'], dtype=np.float32)
+        self.genes = arrays['genes'].tolist()
+        self.gene_sort_order = np.asarray(arrays['gene_sort_order']) if 'gene_sort_order' in arrays \
+            else np.argsort(arrays['genes'], kind='stable')
+        self.label_mapping = arrays['label_mapping'].tolist()
+        self.bit = self.meta['bit']
+        self.n_class = self.meta['n_class']
+        self.n_features = self.meta['n_features']
+
+    def layer(self, i):
+        # float32 (weight, bias) of Linear layer i; memory maps of float32 bundles are used as they are
+        if self._layers[i] is None:
+            weight, bias = self._stored_layers[i]
+            self._layers[i] = (weight if weight.dtype == np.float32 else weight.astype(np.float32),
+                               np.asarray(bias, dtype=np.float32))
+        return self._layers[i]
+
+    @property
+    def layers(self):
+        return [self.layer(i) for i in range(len(self._layers))]
+
+    def forward(self, x):
+        # x: (n, n_features) ndarray or scipy sparse matrix, returns (n, bit) pre-activation codes
+        last = len(self._layers) - 1
+        for i in range(len(self._layers)):
+            weight, bias = self.layer(i)
+            x = np.asarray(x @ weight.T, dtype=np.float32)
+            x += bias
+            if i != last:
+                np.maximum(x, 0, out=x)
+        return x
+
+    def encode(self, data, batch_size=4096):
+        # yields tanh hash codes for consecutive row chunks of data, like scDeepHashModel.encode
+        for start in range(0, data.shape[0], batch_size):
+            yield np.tanh(self.forward(data[start:start + batch_size]))
+
+    def annotate(self, data, batch_size=4096):
+        ''' Label every cell with its closest cell anchor.
+        Returns (labels_pred, nearest_dists, margins), see hamming.annotate_closest_cell_anchor.
+        '''
+        results = [annotate_closest_cell_anchor(codes, self.cell_anchors) for codes in self.encode(data, batch_size)]
+        if not results:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+        return tuple(np.concatenate(parts) for parts in zip(*results))
+
+    def label_names(self, labels_pred):
+        return [self.label_mapping[label] for label in labels_pred]
+
+    def align(self, genes):
+        # gene alignment from an incoming gene panel to the training gene order
+        return GeneAlignment(self.genes, genes, self.gene_sort_order)
+
+
+###------------------------------Gene-space alignment---------------------------------###
+
+class GeneAlignment:
+    ''' Column mapping from an incoming gene panel to the training gene order, computed once
+    and applied to every batch as a column gather. Training genes missing from the panel
+    are filled with zeros, panel genes unknown to the model are dropped, and for duplicated
+    panel genes the first column is used.
+    '''
+
+    def __init__(self, training_genes, genes, sort_order=None):
+        training_genes = np.asarray(training_genes)
+        genes = np.asarray([str(gene) for gene in genes])
+        if sort_order is None:
+            sort_order = np.argsort(training_genes, kind='stable')
+        self.n_features = len(training_genes)
+        self.n_input = len(genes)
+
+        # training position of every panel gene, -1 when unknown
+        sorted_genes = training_genes[sort_order]
+        target = np.full(len(genes), -1, dtype=np.int64)
+        if len(sorted_genes):
+            positions = np.minimum(np.searchsorted(sorted_genes, genes), len(sorted_genes) - 1)
+            hit = sorted_genes[positions] == genes
+            target[hit] = sort_order[positions[hit]]
+        found = target >= 0
+        # keep the first panel column of every training gene
+        matched, first = np.unique(target[found], return_index=True)
+        columns = np.flatnonzero(found)[first]
+
+        self.column_map = np.full(self.n_input, -1, dtype=np.int64)
+        self.column_map[columns] = matched
+        self.source = np.full(self.n_features, -1, dtype=np.int64)
+        self.source[matched] = columns
+        self.present = matched
+        self.n_missing = self.n_features - len(matched)
+        self.identity = self.n_input == self.n_features and np.array_equal(self.source, np.arange(self.n_features))
+
+    def apply(self, matrix):
+        ''' Reorder the columns of a (n, n_input) dense or scipy sparse batch to the training order.
+        Returns a float32 ndarray or a CSR matrix of shape (n, n_features).
+        '''
+        if self.identity:
+            return matrix
+        if scipy.sparse.issparse(matrix):
+            matrix = matrix.tocsr()
+            new_columns = self.column_map[matrix.indices]
+            keep = new_columns >= 0
+            indptr = np.concatenate(([0], np.cumsum(keep)))[matrix.indptr]
+            return scipy.sparse.csr_matrix((matrix.data[keep], new_columns[keep], indptr),
+                                           shape=(matrix.shape[0], self.n_features))
+        aligned = np.zeros((matrix.shape[0], self.n_features), dtype=np.float32)
+        aligned[:, self.present] = np.asarray(matrix)[:, self.source[self.present]]
+        return aligned
+
+    def summary(self):
+        return "{} of {} training genes found in the {} input genes, {} filled with zeros".format(
+            self.n_features - self.n_missing, self.n_features, self.n_input, self.n_missing)
+
+
+def load_bundle(path):
+    return ModelBundle(path)
@@ -0,0 +1,57 @@
+import os
+import sys
+import numpy as np
+
+###------------------------------Cross-validation folds---------------------------------###
+# The benchmark datasets ship their folds as CV_folds.RData (Test_Idx, Train_Idx: one vector
+# of 1-based cell indices per fold, Cells_to_Keep: logical mask over the cells). Reading it
+# needs an embedded R interpreter through rpy2, so it is converted once to CV_folds.npz next
+# to it (per-fold object arrays, loaded with allow_pickle like the pbmc68k data split) and
+# later runs only read the NPZ. rpy2 is imported only when a conversion is needed.
+
+
+def convert_cv_folds(rdata_path, npz_path=None):
+    ''' Convert CV_folds.RData to an NPZ with the same Test_Idx, Train_Idx and Cells_to_Keep entries.
+    Returns the path of the NPZ.
+    '''
+    import rpy2.robjects as robjects
+    from rpy2.robjects import pandas2ri
+    from rpy2.robjects.conversion import localconverter
+
+    if npz_path is None:
+        npz_path = os.path.splitext(rdata_path)[0] + '.npz'
+    print("Converting", rdata_path, "to", npz_path)
+    robjects.r['load'](rdata_path)
+    with localconverter(robjects.default_converter + pandas2ri.converter):
+        test_idx = robjects.conversion.rpy2py(robjects.r['Test_Idx'])
+        train_idx = robjects.conversion.rpy2py(robjects.r['Train_Idx'])
+        cells_to_keep = robjects.conversion.rpy2py(robjects.r['Cells_to_Keep'])
+
+    def folds(idx):
+        array = np.empty(len(idx), dtype=object)
+        for i in range(len(idx)):
+            array[i] = np.asarray(idx[i], dtype=np.int64)
+        return array
+
+    tmp_path = npz_path + '.tmp{}.npz'.format(os.getpid())
+    np.savez(tmp_path, Test_Idx=folds(test_idx), Train_Idx=folds(train_idx),
+             Cells_to_Keep=np.asarray(cells_to_keep, dtype=bool))
+    os.replace(tmp_path, npz_path)
+    return npz_path
+
+
+def load_cv_folds(dataset_dir):
+    ''' Load (test_idx, train_idx, cells_to_keep) of a dataset directory, converting
+    CV_folds.RData to CV_folds.npz on first use. Fold indices are 1-based as in the RData.
+    '''
+    npz_path = os.path.join(dataset_dir, 'CV_folds.npz')
+    if not os.path.exists(npz_path):
+        convert_cv_folds(os.path.join(dataset_dir, 'CV_folds.RData'), npz_path)
+    folds = np.load(npz_path, allow_pickle=True)
+    return folds['Test_Idx'], folds['Train_Idx'], folds['Cells_to_Keep']
+
+
+if __name__ == '__main__':
+    # python cvFolds.py data/TM/CV_folds.RData [...]: convert ahead of time
+    for path in sys.argv[1:]:
+        convert_cv_folds(path)
@@ -0,0 +1,164 @@
+import hashlib
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+###------------------------------Binary cache for expression matrices---------------------------------###
+# A cell-by-gene CSV is parsed once into a float32 matrix and stored under a key
+# derived from the CSV content (and the kept rows). Later runs (and other folds)
+# memory-map the cached matrix instead of parsing the CSV again. The CSV is streamed
+# in row chunks, so building the cache never holds the full matrix in memory.
+#
+# Cache entry layout (<cache_dir>/<csv name>-<dense|csr>-<content hash>[-<kept rows hash>]/):
+#   data.npy                              dense float32 matrix, or
+#   data.npy, indices.npy, indptr.npy,    CSR float32 matrix
+#   shape.npy
+#   genes.txt, cells.txt                  column and row names, one per line
+
+
+# content hashes per (path, size, mtime_ns), so a file is only read again when it changes
+_content_hashes = {}
+
+
+def file_content_hash(path, block_size=1 << 24):
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _content_hashes:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                sha.update(block)
+        _content_hashes[key] = sha.hexdigest()
+    return _content_hashes[key]
+
+
+def _default_cache_dir(csv_path):
+    return os.path.join(os.path.dirname(os.path.abspath(csv_path)), '.cache')
+
+
+def count_csv_rows(csv_path, block_size=1 << 24):
+    # number of data rows (lines after the header) without parsing the file
+    n_lines, last = 0, b'\n'
+    with open(csv_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            n_lines += block.count(b'\n')
+            last = block[-1:]
+    if last != b'\n':
+        n_lines += 1
+    return n_lines - 1
+
+
+def get_cache_entry(csv_path, cache_dir=None, sparse=False, row_mask=None):
+    if cache_dir is None:
+        cache_dir = _default_cache_dir(csv_path)
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    kind = 'csr' if sparse else 'dense'
+    key = file_content_hash(csv_path)[:16]
+    if row_mask is not None:
+        key += '-' + hashlib.sha1(np.packbits(np.asarray(row_mask, dtype=bool)).tobytes()).hexdigest()[:8]
+    return os.path.join(cache_dir, "{}-{}-{}".format(name, kind, key))
+
+
+def _write_names(path, names):
+    with open(path, 'w') as f:
+        f.write('\n'.join(str(name) for name in names))
+
+
+def _read_names(path):
+    with open(path) as f:
+        return f.read().split('\n')
+
+
+def _raw_to_npy(raw_path, npy_path, dtype, length, block=1 << 24):
+    # wrap an appended raw binary file into a .npy without loading it at once
+    out = np.lib.format.open_memmap(npy_path, mode='w+', dtype=dtype, shape=(length,))
+    if length:
+        raw = np.memmap(raw_path, dtype=dtype, mode='r', shape=(length,))
+        for start in range(0, length, block):
+            out[start:start + block] = raw[start:start + block]
+    out.flush()
+    os.remove(raw_path)
+
+
+def _build_cache_entry(csv_path, entry, sparse, row_mask=None, chunksize=2000):
+    # Stream the CSV in row chunks and write only the kept rows straight to disk,
+    # so matrices larger than RAM can be ingested
+    print("Building expression cache for", csv_path)
+    genes = pd.read_csv(csv_path, index_col=0, sep=',', nrows=0).columns
+    if row_mask is not None:
+        row_mask = np.asarray(row_mask, dtype=bool)
+        n_rows = int(row_mask.sum())
+    else:
+        n_rows = count_csv_rows(csv_path)
+
+    tmp_entry = entry + '.tmp{}'.format(os.getpid())
+    os.makedirs(tmp_entry, exist_ok=True)
+    if sparse:
+        raw_files = {name: open(os.path.join(tmp_entry, name + '.raw'), 'wb') for name in ('data', 'indices')}
+        indptr = [np.zeros(1, dtype=np.int64)]
+        nnz = 0
+    else:
+        matrix = np.lib.format.open_memmap(os.path.join(tmp_entry, 'data.npy'), mode='w+',
+                                           dtype=np.float32, shape=(n_rows, len(genes)))
+    cells = []
+    row, written = 0, 0
+    for chunk in pd.read_csv(csv_path, index_col=0, sep=',', chunksize=chunksize, dtype={name: np.float32 for name in genes}):
+        if row_mask is not None:
+            keep = row_mask[row:row + len(chunk)]
+            row += len(chunk)
+            chunk = chunk[keep]
+        values = np.asarray(chunk, dtype=np.float32)
+        if sparse:
+            values = scipy.sparse.csr_matrix(values)
+            raw_files['data'].write(values.data.astype(np.float32).tobytes())
+            raw_files['indices'].write(values.indices.astype(np.int32).tobytes())
+            indptr.append(values.indptr[1:].astype(np.int64) + nnz)
+            nnz += values.nnz
+        else:
+            matrix[written:written + values.shape[0]] = values
+        written += values.shape[0]
+        cells.extend(chunk.index)
+    assert written == n_rows, "Expected {} rows in {}, found {}".format(n_rows, csv_path, written)
+
+    if sparse:
+        for f in raw_files.values():
+            f.close()
+        _raw_to_npy(os.path.join(tmp_entry, 'data.raw'), os.path.join(tmp_entry, 'data.npy'), np.float32, nnz)
+        _raw_to_npy(os.path.join(tmp_entry, 'indices.raw'), os.path.join(tmp_entry, 'indices.npy'), np.int32, nnz)
+        np.save(os.path.join(tmp_entry, 'indptr.npy'), np.concatenate(indptr))
+        np.save(os.path.join(tmp_entry, 'shape.npy'), np.array([n_rows, len(genes)]))
+    else:
+        matrix.flush()
+        del matrix
+    _write_names(os.path.join(tmp_entry, 'genes.txt'), genes)
+    _write_names(os.path.join(tmp_entry, 'cells.txt'), cells)
+    # publish the entry atomically so concurrent runs never see a partial cache
+    try:
+        os.rename(tmp_entry, entry)
+    except OSError:
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+
+
+def load_expression_matrix(csv_path, cache_dir=None, sparse=False, row_mask=None):
+    ''' Load a cell-by-gene CSV through the binary cache.
+    row_mask: optional boolean mask over the CSV rows, only kept rows are stored
+    Returns (data, genes, cells) where data is a read-only memory-mapped float32
+    ndarray, or a scipy CSR matrix over memory-mapped arrays when sparse=True.
+    '''
+    entry = get_cache_entry(csv_path, cache_dir, sparse, row_mask)
+    if not os.path.isdir(entry):
+        _build_cache_entry(csv_path, entry, sparse, row_mask)
+
+    if sparse:
+        shape = tuple(np.load(os.path.join(entry, 'shape.npy')))
+        data = scipy.sparse.csr_matrix((np.load(os.path.join(entry, 'data.npy'), mmap_mode='r'),
+                                        np.load(os.path.join(entry, 'indices.npy'), mmap_mode='r'),
+                                        np.load(os.path.join(entry, 'indptr.npy'), mmap_mode='r')),
+                                       shape=shape, copy=False)
+    else:
+        data = np.load(os.path.join(entry, 'data.npy'), mmap_mode='r')
+    genes = _read_names(os.path.join(entry, 'genes.txt'))
+    cells = _read_names(os.path.join(entry, 'cells.txt'))
+    return data, genes, cells
@@ -1,39 +1,66 @@
-from collections import Counter
 import torch
-from torchvision import models
-from torch import nn
 import pytorch_lightning as pl
 from sklearn.model_selection import train_test_split
-from torch.utils.data import DataLoader, random_split, Subset, Dataset
-from torch.nn import functional as F
-from torchvision import datasets, transforms
+from torch.utils.data import DataLoader, Subset, Dataset, BatchSampler, RandomSampler, SequentialSampler
 import os
-from collections import Counter
-import statistics
 import scipy.sparse
 
-from torchvision.datasets.utils import download_and_extract_archive
 import pandas as pd
 import numpy as np
 from sklearn import preprocessing
 
-import rpy2.robjects as robjects
-from rpy2.robjects import pandas2ri
-from rpy2.robjects.conversion import localconverter
+from dataCache import load_expression_matrix
+from cvFolds import load_cv_folds
 
 ###------------------------------Utility function for DataLoader---------------------------------###
+# torchvision is only needed to download a dataset, so it is imported on first use
+def download_and_extract_archive(*args, **kwargs):
+  from torchvision.datasets.utils import download_and_extract_archive
+  return download_and_extract_archive(*args, **kwargs)
+
+
 # selecting genes, input is the pandas dataframe
+# The selected genes keep their column order, so every call on the same data returns the same list
 def gene_selection(df, num_of_gene=10000):
   print("Before feature selection:")
   print(df)
   topMeanGene = df.mean().sort_values(ascending=False)
   topVarGene = df.var().sort_values(ascending=False)
-  selectedgene = list(set(topMeanGene.index[0:num_of_gene]).union(set(topVarGene.index[0:num_of_gene])))
+  selected = set(topMeanGene.index[0:num_of_gene]).union(set(topVarGene.index[0:num_of_gene]))
+  selectedgene = [gene for gene in df.columns if gene in selected]
   print("After feature selection:")
   print(df[selectedgene])
   return df[selectedgene]
 
 
+# Genes kept by feature selection for every CSV path, chosen once per process
+_selected_genes = {}
+
+
+# Names of the genes selected on all rows of a CSV, independent of the cells kept later
+def select_genes(data_path):
+  if data_path not in _selected_genes:
+    data, genes, cells = load_expression_matrix(data_path)
+    _selected_genes[data_path] = list(gene_selection(pd.DataFrame(data, index=cells, columns=genes, copy=False)).columns)
+  return _selected_genes[data_path]
+
+
+# Load a cell-by-gene CSV through the binary cache, optionally with feature selection
+# Only the rows selected by cells_to_keep are read into the cache. With feature selection
+# the genes are chosen on the unmasked matrix (as N_FEATURES is) and the rows are masked after
+# Returns the float32 expression matrix and the gene names of its columns
+def load_expression_data(data_path, feature_selection=False, cells_to_keep=None):
+  if not feature_selection:
+    data, genes, _ = load_expression_matrix(data_path, row_mask=cells_to_keep)
+    return data, genes
+  selected = select_genes(data_path)
+  data, genes, _ = load_expression_matrix(data_path)
+  gene_index = {gene: i for i, gene in enumerate(genes)}
+  columns = np.array([gene_index[gene] for gene in selected], dtype=np.int64)
+  rows = np.arange(data.shape[0]) if cells_to_keep is None else np.flatnonzero(np.asarray(cells_to_keep, dtype=bool))
+  return np.ascontiguousarray(data[np.ix_(rows, columns)], dtype=np.float32), selected
+
+
 # Used to discard labels with occurence smaller than 10
 def preprocess_data(full_labels, import_size=None):
 
@@ -43,47 +70,59 @@ def preprocess_data(full_labels, import_size=None):
     int_labels = le.transform(full_labels.ravel())
 
     # Step #2: Prepare indices for the proportion of data that we are going to read in
-    full_indices = range(len(full_labels))
+    full_indices = np.arange(len(int_labels))
+    discarded = np.zeros(len(int_labels), dtype=bool)
     if import_size == 1 or import_size is None:
         import_indices = full_indices
-        discarded_indices = []
     else:
         import_indices, discarded_indices = train_test_split(
             full_indices, train_size=import_size, stratify=int_labels, random_state=21)
+        discarded[discarded_indices] = True
 
     print("Number of data to import:", len(import_indices))
     print("Number of total data:", len(full_labels))
 
     # Step #3: Preprocess data and only keep cells with population larger than 10
-    imported_labels = [int_labels[i] for i in import_indices]
-    occurence_dict = Counter(imported_labels)
-    remove_labels = []
-    for label in occurence_dict:
-        num_of_occurence = occurence_dict[label]
-        if num_of_occurence < 10:
-            remove_labels.append(label)
-    imported_labels = None
-    import_indices = None
-
-    for label in remove_labels:
-        remove_temp = [i for i, x in enumerate(int_labels) if x == label]
-        discarded_indices.extend(remove_temp)
-
-    remaining_indices = [e for e in full_indices if e not in discarded_indices]
-    remaining_labels = [int_labels[i] for i in remaining_indices]
-    print("Number of data after filtering:", len(remaining_indices))
+    occurence = count_samples_in_each_class(int_labels[import_indices], len(le.classes_))
+    remove_labels = (occurence > 0) & (occurence < 10)
+    discarded |= remove_labels[int_labels]
+
+    remaining_labels = int_labels[~discarded]
+    print("Number of data after filtering:", len(remaining_labels))
     print("Number of classes after filtering:",
           len(np.unique(remaining_labels)))
 
     remaining_labels = list(le.inverse_transform(remaining_labels))
 
-    return remaining_labels, discarded_indices
+    return remaining_labels, np.flatnonzero(discarded)
+
+# Count the samples of each class from an integer label array
+def count_samples_in_each_class(labels, n_class=0):
+    return np.bincount(np.asarray(labels).ravel(), minlength=n_class)
+
+# Per-class sample counts of the splits over all label ids (0 .. n_class - 1 of the label mapping).
+# Sets N_CLASS and samples_in_each_class of the datamodule from the training split, so cell
+# anchors and class-balanced loss weights line up with the label ids
+def set_class_counts(datamodule, train_labels, val_labels=None, test_labels=None):
+    n_class = len(datamodule.label_mapping.classes_)
+    train_class_counts = count_samples_in_each_class(train_labels, n_class)
+    print("training samples in each class =", train_class_counts.tolist())
+    for name, labels in (("val", val_labels), ("test", test_labels)):
+        if labels is not None:
+            print(name, "samples in each class =", count_samples_in_each_class(labels, n_class).tolist())
+    missing = np.flatnonzero(train_class_counts == 0)
+    if len(train_class_counts) > n_class or missing.size:
+        raise ValueError("Label ids must be 0 .. {} with training samples for every class, missing: {}".format(
+            n_class - 1, [str(datamodule.label_mapping.classes_[i]) for i in missing]))
+    datamodule.N_CLASS = n_class
+    print("Changing N_CLASS =", datamodule.N_CLASS)
+    datamodule.samples_in_each_class = torch.tensor(train_class_counts, dtype=torch.float32)
 
 # Perform stratified split on a dataset into two sets based on indices
 
 
 def stratified_split(remaining_indices, full_labels, set1_split_percentage):
-    target_labels = [full_labels[i] for i in remaining_indices]
+    target_labels = np.asarray(full_labels)[np.asarray(remaining_indices)]
     set1_indices, set2_indices = train_test_split(
         remaining_indices, train_size=set1_split_percentage, stratify=target_labels)
     return set1_indices, set2_indices
@@ -112,7 +151,10 @@ def split_train_val_database_sets(full_dataset, train_idx, train_percentage):
     full_indices = range(len(full_labels))
 
     train_indices, val_indices = stratified_split(train_idx, full_labels, train_percentage)
-    train_set, val_set  = (Subset(full_dataset, train_indices), Subset(full_dataset, val_indices))
+    if isinstance(full_dataset, TensorBatchDataset):
+        train_set, val_set = (full_dataset.subset(train_indices), full_dataset.subset(val_indices))
+    else:
+        train_set, val_set  = (Subset(full_dataset, train_indices), Subset(full_dataset, val_indices))
     
     return train_set, val_set
 
@@ -135,6 +177,38 @@ class CustomDataset(Dataset):
         # Load data and get label
         return self.data[index], self.labels[index]
 
+class TensorBatchDataset(Dataset):
+    'A dataset over one shared in-memory (or memory-mapped) array that serves whole batches'
+
+    def __init__(self, data, labels, indices=None):
+        'Dataset Class Initialization'
+        # Number of data and labels should match
+        assert len(data) == len(labels)
+        self.data = data
+        self.all_labels = np.asarray(labels)
+        self.indices = np.arange(len(labels)) if indices is None else np.asarray(indices)
+
+    @property
+    def labels(self):
+        return self.all_labels[self.indices]
+
+    def subset(self, indices):
+        'Returns a dataset over the given positions, sharing the same array'
+        return TensorBatchDataset(self.data, self.all_labels, self.indices[np.asarray(indices)])
+
+    def __len__(self):
+        'Returns the total number of samples'
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        # Load data and get label
+        rows = self.indices[index]
+        if np.ndim(rows) == 0:
+            return self.data[rows], self.all_labels[rows]
+        # A whole batch of indices: fancy-index the shared array once
+        return torch.from_numpy(np.ascontiguousarray(self.data[rows])), torch.from_numpy(self.all_labels[rows])
+
+
 class SparseCustomDataset(Dataset):
     "A dataset base class for PyTorch Lightening"
 
@@ -149,23 +223,44 @@ class SparseCustomDataset(Dataset):
         "Returns the total number of samples"
         return self.data.shape[0]
 
-    def __getitem__(self, index: int):
+    def __getitem__(self, index):
         # Load data and get label
-        return self.data[index].toarray()[0], self.labels[index]
+        if np.ndim(index) == 0:
+            return self.data[index].toarray()[0], self.labels[index]
+        # A whole batch of indices: slice the CSR rows at once and return a sparse tensor
+        batch = self.data[np.asarray(index)].tocoo()
+        indices = torch.from_numpy(np.vstack((batch.row, batch.col)).astype(np.int64))
+        values = torch.from_numpy(batch.data.astype(np.float32))
+        data = torch.sparse_coo_tensor(indices, values, batch.shape)
+        return data, torch.as_tensor(self.labels[np.asarray(index)])
+
+
+# DataLoader that hands a whole batch of indices to the dataset at once
+# instead of fetching every sample and collating them
+# Sparse batches are built in the main process: torch 1.9 cannot send sparse tensors
+# out of worker processes, and slicing CSR rows is cheap
+def batch_dataloader(dataset, batch_size, shuffle=False, num_workers=0, pin_memory=False):
+    if isinstance(dataset, SparseCustomDataset):
+        num_workers = 0
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last=False),
+                      batch_size=None, num_workers=num_workers, pin_memory=pin_memory)
 
 
 ###------------------------------Data Module---------------------------------###
 
 class TMDataModule(pl.LightningDataModule):
 
-    def __init__(self, data_dir: str = './data', batch_size=64, num_workers=2, import_size=0.4, fold_num=0, feature_selection=False):
+    def __init__(self, data_dir: str = './data', batch_size=64, num_workers=2, import_size=1, fold_num=0, feature_selection=False, pin_memory=False):
         super().__init__()
+        self.pin_memory = pin_memory
         self.data_dir = data_dir
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.data_name = "TM"
-        self.import_size = import_size # Percentage of original dataset, Total dataset size = 54865. Went to 0.4 without crashing
+        self.import_size = import_size # Percentage of original dataset, Total dataset size = 54865. The CSV is streamed into the on-disk cache, so the full dataset fits
         self.label_mapping = None
+        self.gene_names = None
         self.N_FEATURES = 19791
         self.N_CLASS = 55
         self.fold_num = fold_num # fold_num 可以是 0-4
@@ -173,9 +268,7 @@ class TMDataModule(pl.LightningDataModule):
         self.feature_selection = feature_selection
         if feature_selection:
           DataPath = self.data_dir + "/" + self.data_name + "/Filtered_TM_data.csv"
-          data = pd.read_csv(DataPath, index_col=0, sep=',')
-          data = gene_selection(data)
-          self.N_FEATURES = data.shape[1]
+          self.N_FEATURES = len(select_genes(DataPath))
 
     def prepare_data(self):
         # download
@@ -190,14 +283,10 @@ class TMDataModule(pl.LightningDataModule):
         print("Using fold_num {}".format(self.fold_num))
 
         DataPath = self.data_dir + "/" + self.data_name + "/Filtered_TM_data.csv"
+        self.data_path = DataPath
         LabelsPath = self.data_dir + "/" + self.data_name + "/Labels.csv"
 
-        rf = robjects.r['load'](self.data_dir + "/" + self.data_name + "/CV_folds.RData")
-
-        with localconverter(robjects.default_converter + pandas2ri.converter):
-          test_idx = robjects.conversion.rpy2py(robjects.r['Test_Idx'])
-          train_idx = robjects.conversion.rpy2py(robjects.r['Train_Idx'])
-          cells_to_keep = robjects.conversion.rpy2py(robjects.r['Cells_to_Keep'])
+        test_idx, train_idx, cells_to_keep = load_cv_folds(self.data_dir + "/" + self.data_name)
 
         # Step #1: Read in all labels and keep cells with count > 10
         cells_to_keep = np.array(cells_to_keep, dtype=bool)
@@ -222,66 +311,51 @@ class TMDataModule(pl.LightningDataModule):
         int_labels = None
 
         # Step #3: Read in data based on selected label indices
-        data = pd.read_csv(DataPath, index_col=0, sep=',')
-        if self.feature_selection:
-          data = gene_selection(data)
-
-        full_data = np.asarray(data, dtype=np.float32)
-        full_data = full_data[cells_to_keep]
+        full_data, self.gene_names = load_expression_data(DataPath, self.feature_selection, cells_to_keep)
 
-        full_dataset = CustomDataset(data=full_data, labels=full_labels)
+        full_dataset = TensorBatchDataset(data=full_data, labels=full_labels)
         test_idx = np.array(test_idx[self.fold_num]) - 1
         train_idx = np.array(train_idx[self.fold_num]) - 1
 
-        self.TM_test = Subset(full_dataset, test_idx)
+        self.TM_test = full_dataset.subset(test_idx)
         self.TM_train, self.TM_val = split_train_val_database_sets(full_dataset, train_idx, train_percentage=0.75)
         print("train size =", len(self.TM_train))
         print("val size =", len(self.TM_val))
         print("test size =", len(self.TM_test))
 
         # Calculate sample count in each class for training dataset
-        samples_in_each_class_dict = Counter([data[1] for data in self.TM_train])
-        print("training samples in each class =", samples_in_each_class_dict)
-        samples_in_each_class_dict_val = Counter([data[1] for data in self.TM_val])
-        print("val samples in each class =", samples_in_each_class_dict_val)
-        samples_in_each_class_dict_test = Counter([data[1] for data in self.TM_test])
-        print("test samples in each class =", samples_in_each_class_dict_test)
-        self.N_CLASS = len(samples_in_each_class_dict)
-        print("Changing N_CLASS =", self.N_CLASS)
-        self.samples_in_each_class = torch.zeros(self.N_CLASS)
-        for index, count in samples_in_each_class_dict.items():
-           self.samples_in_each_class[index] = count
+        set_class_counts(self, self.TM_train.labels, self.TM_val.labels, self.TM_test.labels)
 
     def train_dataloader(self):
-        return DataLoader(self.TM_train, batch_size=self.batch_size,
-                          shuffle=True, num_workers=self.num_workers)
+        return batch_dataloader(self.TM_train, batch_size=self.batch_size,
+                                shuffle=True, pin_memory=self.pin_memory)
 
     def val_dataloader(self):
-        return DataLoader(self.TM_val, batch_size=self.batch_size,
-                          num_workers=self.num_workers)
+        return batch_dataloader(self.TM_val, batch_size=self.batch_size,
+                                pin_memory=self.pin_memory)
 
     def test_dataloader(self):
-        return DataLoader(self.TM_test, batch_size=self.batch_size,
-                          num_workers=self.num_workers)
+        return batch_dataloader(self.TM_test, batch_size=self.batch_size,
+                                pin_memory=self.pin_memory)
 
 
 class BaronHumanDataModule(pl.LightningDataModule):
 
-    def __init__(self, data_dir: str = './data', batch_size=64, num_workers=2, fold_num=0, feature_selection=False):
+    def __init__(self, data_dir: str = './data', batch_size=64, num_workers=2, fold_num=0, feature_selection=False, pin_memory=False):
         super().__init__()
+        self.pin_memory = pin_memory
         self.data_dir = data_dir
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.data_name = "BaronHuman"
         self.label_mapping = None
+        self.gene_names = None
         self.fold_num = fold_num # fold_num 可以是 0-4
         self.feature_selection = feature_selection
         self.N_FEATURES = 17499
         if feature_selection:
           DataPath = self.data_dir + "/" + self.data_name + "/Filtered_Baron_HumanPancreas_data.csv"
-          data = pd.read_csv(DataPath, index_col=0, sep=',')
-          data = gene_selection(data)
-          self.N_FEATURES = data.shape[1]
+          self.N_FEATURES = len(select_genes(DataPath))
 
     def prepare_data(self):
         # download
@@ -296,14 +370,9 @@ class BaronHumanDataModule(pl.LightningDataModule):
         print("Using fold_num {}".format(self.fold_num))
 
         DataPath = self.data_dir + "/" + self.data_name + "/Filtered_Baron_HumanPancreas_data.csv"
+        self.data_path = DataPath
         LabelsPath = self.data_dir + "/" + self.data_name + "/Labels.csv"
-        print("loading..." + self.data_dir + "/" + self.data_name + "/CV_folds.RData")
-        rf = robjects.r['load'](self.data_dir + "/" + self.data_name + "/CV_folds.RData")
-
-        with localconverter(robjects.default_converter + pandas2ri.converter):
-          test_idx = robjects.conversion.rpy2py(robjects.r['Test_Idx'])
-          train_idx = robjects.conversion.rpy2py(robjects.r['Train_Idx'])
-          cells_to_keep = robjects.conversion.rpy2py(robjects.r['Cells_to_Keep'])
+        test_idx, train_idx, cells_to_keep = load_cv_folds(self.data_dir + "/" + self.data_name)
 
         # Step #1: Read in all labels and keep cells with count > 10
         cells_to_keep = np.array(cells_to_keep, dtype=bool)
@@ -323,68 +392,53 @@ class BaronHumanDataModule(pl.LightningDataModule):
         int_labels = None
 
         # Step #3: Read in data based on selected label indices
-        data = pd.read_csv(DataPath, index_col=0, sep=',')
-        if self.feature_selection:
-          data = gene_selection(data)
-
-        full_data = np.asarray(data, dtype=np.float32)
-        full_data = full_data[cells_to_keep]
+        full_data, self.gene_names = load_expression_data(DataPath, self.feature_selection, cells_to_keep)
 
-        full_dataset = CustomDataset(data=full_data, labels=full_labels)
+        full_dataset = TensorBatchDataset(data=full_data, labels=full_labels)
         test_idx = np.array(test_idx[self.fold_num]) - 1
         train_idx = np.array(train_idx[self.fold_num]) - 1
 
-        self.Baron_Human_test = Subset(full_dataset, test_idx)
+        self.Baron_Human_test = full_dataset.subset(test_idx)
         self.Baron_Human_train, self.Baron_Human_val = split_train_val_database_sets(full_dataset, train_idx, train_percentage=0.75)
         print("train size =", len(self.Baron_Human_train))
         print("val size =", len(self.Baron_Human_val))
         print("test size =", len(self.Baron_Human_test))
 
         # Calculate sample count in each class for training dataset
-        samples_in_each_class_dict = Counter([data[1] for data in self.Baron_Human_train])
-        print("training samples in each class =", samples_in_each_class_dict)
-        samples_in_each_class_dict_val = Counter([data[1] for data in self.Baron_Human_val])
-        print("val samples in each class =", samples_in_each_class_dict_val)
-        samples_in_each_class_dict_test = Counter([data[1] for data in self.Baron_Human_test])
-        print("test samples in each class =", samples_in_each_class_dict_test)
-        self.N_CLASS = len(samples_in_each_class_dict)
-        print("Changing N_CLASS =", self.N_CLASS)
-        self.samples_in_each_class = torch.zeros(self.N_CLASS)
-        for index, count in samples_in_each_class_dict.items():
-           self.samples_in_each_class[index] = count
+        set_class_counts(self, self.Baron_Human_train.labels, self.Baron_Human_val.labels, self.Baron_Human_test.labels)
 
     def train_dataloader(self):
-        return DataLoader(self.Baron_Human_train, batch_size=self.batch_size,
-                          shuffle=True, num_workers=self.num_workers)
+        return batch_dataloader(self.Baron_Human_train, batch_size=self.batch_size,
+                                shuffle=True, pin_memory=self.pin_memory)
 
     def val_dataloader(self):
-        return DataLoader(self.Baron_Human_val, batch_size=self.batch_size,
-                          num_workers=self.num_workers)
+        return batch_dataloader(self.Baron_Human_val, batch_size=self.batch_size,
+                                pin_memory=self.pin_memory)
 
     def test_dataloader(self):
-        return DataLoader(self.Baron_Human_test, batch_size=self.batch_size,
-                          num_workers=self.num_workers)
+        return batch_dataloader(self.Baron_Human_test, batch_size=self.batch_size,
+                                pin_memory=self.pin_memory)
 
 
 class Zheng68KDataModule(pl.LightningDataModule):
 
-    def __init__(self, data_dir: str = './data', batch_size=64, num_workers=2, import_size=0.4, fold_num=0, feature_selection=False):
+    def __init__(self, data_dir: str = './data', batch_size=64, num_workers=2, import_size=0.4, fold_num=0, feature_selection=False, pin_memory=False):
         super().__init__()
+        self.pin_memory = pin_memory
         self.data_dir = data_dir
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.data_name = "Zheng_68K"
         self.import_size = import_size # Percentage of original dataset, Total dataset size = 54865. Went to 0.4 without crashing
         self.label_mapping = None
+        self.gene_names = None
         self.N_FEATURES = 20387
         self.N_CLASS = 11
         self.fold_num = fold_num # fold_num 可以是 0-4
         self.feature_selection = feature_selection
         if self.feature_selection:
           DataPath = self.data_dir + "/" + self.data_name + "/Filtered_68K_PBMC_data.csv"
-          data = pd.read_csv(DataPath, index_col=0, sep=',')
-          data = gene_selection(data)
-          self.N_FEATURES = data.shape[1]
+          self.N_FEATURES = len(select_genes(DataPath))
 
     def prepare_data(self):
         # download
@@ -399,14 +453,10 @@ class Zheng68KDataModule(pl.LightningDataModule):
         print("Using fold_num {}".format(self.fold_num))
 
         DataPath = self.data_dir + "/" + self.data_name + "/Filtered_68K_PBMC_data.csv"
+        self.data_path = DataPath
         LabelsPath = self.data_dir + "/" + self.data_name + "/Labels.csv"
 
-        rf = robjects.r['load'](self.data_dir + "/" + self.data_name + "/CV_folds.RData")
-
-        with localconverter(robjects.default_converter + pandas2ri.converter):
-          test_idx = robjects.conversion.rpy2py(robjects.r['Test_Idx'])
-          train_idx = robjects.conversion.rpy2py(robjects.r['Train_Idx'])
-          cells_to_keep = robjects.conversion.rpy2py(robjects.r['Cells_to_Keep'])
+        test_idx, train_idx, cells_to_keep = load_cv_folds(self.data_dir + "/" + self.data_name)
 
         # Step #1: Read in all labels and keep cells with count > 10
         cells_to_keep = np.array(cells_to_keep, dtype=bool)
@@ -426,53 +476,39 @@ class Zheng68KDataModule(pl.LightningDataModule):
         int_labels = None
 
         # Step #3: Read in data based on selected label indices
-        data = pd.read_csv(DataPath, index_col=0, sep=',')
-        if self.feature_selection:
-          data = gene_selection(data)
-
-        full_data = np.asarray(data, dtype=np.float32)
-        full_data = full_data[cells_to_keep]
+        full_data, self.gene_names = load_expression_data(DataPath, self.feature_selection, cells_to_keep)
 
-        full_dataset = CustomDataset(data=full_data, labels=full_labels)
+        full_dataset = TensorBatchDataset(data=full_data, labels=full_labels)
         test_idx = np.array(test_idx[self.fold_num]) - 1
         train_idx = np.array(train_idx[self.fold_num]) - 1
 
-        self.Zheng_68K_test = Subset(full_dataset, test_idx)
+        self.Zheng_68K_test = full_dataset.subset(test_idx)
         self.Zheng_68K_train, self.Zheng_68K_val = split_train_val_database_sets(full_dataset, train_idx, train_percentage=0.75)
         print("train size =", len(self.Zheng_68K_train))
         print("val size =", len(self.Zheng_68K_val))
         print("test size =", len(self.Zheng_68K_test))
 
         # Calculate sample count in each class for training dataset
-        samples_in_each_class_dict = Counter([data[1] for data in self.Zheng_68K_train])
-        print("training samples in each class =", samples_in_each_class_dict)
-        samples_in_each_class_dict_val = Counter([data[1] for data in self.Zheng_68K_val])
-        print("val samples in each class =", samples_in_each_class_dict_val)
-        samples_in_each_class_dict_test = Counter([data[1] for data in self.Zheng_68K_test])
-        print("test samples in each class =", samples_in_each_class_dict_test)
-        self.N_CLASS = len(samples_in_each_class_dict)
-        print("Changing N_CLASS =", self.N_CLASS)
-        self.samples_in_each_class = torch.zeros(self.N_CLASS)
-        for index, count in samples_in_each_class_dict.items():
-           self.samples_in_each_class[index] = count
+        set_class_counts(self, self.Zheng_68K_train.labels, self.Zheng_68K_val.labels, self.Zheng_68K_test.labels)
 
     def train_dataloader(self):
-        return DataLoader(self.Zheng_68K_train, batch_size=self.batch_size,
-                          shuffle=True, num_workers=self.num_workers)
+        return batch_dataloader(self.Zheng_68K_train, batch_size=self.batch_size,
+                                shuffle=True, pin_memory=self.pin_memory)
 
     def val_dataloader(self):
-        return DataLoader(self.Zheng_68K_val, batch_size=self.batch_size,
-                          num_workers=self.num_workers)
+        return batch_dataloader(self.Zheng_68K_val, batch_size=self.batch_size,
+                                pin_memory=self.pin_memory)
 
     def test_dataloader(self):
-        return DataLoader(self.Zheng_68K_test, batch_size=self.batch_size,
-                          num_workers=self.num_workers)
+        return batch_dataloader(self.Zheng_68K_test, batch_size=self.batch_size,
+                                pin_memory=self.pin_memory)
 
 
 class AMBDataModule(pl.LightningDataModule):
 
-    def __init__(self, data_dir: str = './data', batch_size=64, num_workers=2, annotation_level=92, fold_num=0, feature_selection=False):
+    def __init__(self, data_dir: str = './data', batch_size=64, num_workers=2, annotation_level=92, fold_num=0, feature_selection=False, pin_memory=False):
         super().__init__()
+        self.pin_memory = pin_memory
         assert annotation_level in [3, 16, 92], "Annotation level must be one of 3, 16 or 92!"
         self.data_dir = data_dir
         self.batch_size = batch_size
@@ -480,15 +516,14 @@ class AMBDataModule(pl.LightningDataModule):
         self.data_name = "AMB"
         self.annotation_level = annotation_level
         self.label_mapping = None
+        self.gene_names = None
         self.fold_num = fold_num # fold_num 可以是 0-4
         self.feature_selection=feature_selection
         self.N_FEATURES = 42625
 
         if self.feature_selection:
           DataPath = self.data_dir + "/" + self.data_name + "/Filtered_mouse_allen_brain_data.csv"
-          data = pd.read_csv(DataPath, index_col=0, sep=',')
-          data = gene_selection(data)
-          self.N_FEATURES = data.shape[1]
+          self.N_FEATURES = len(select_genes(DataPath))
 
     def prepare_data(self):
         # download
@@ -503,14 +538,10 @@ class AMBDataModule(pl.LightningDataModule):
         print("Using fold_num {}".format(self.fold_num))
 
         DataPath = self.data_dir + "/" + self.data_name + "/Filtered_mouse_allen_brain_data.csv"
+        self.data_path = DataPath
         LabelsPath = self.data_dir + "/" + self.data_name + "/Labels.csv"
 
-        rf = robjects.r['load'](self.data_dir + "/" + self.data_name + "/CV_folds.RData")
-
-        with localconverter(robjects.default_converter + pandas2ri.converter):
-          test_idx = robjects.conversion.rpy2py(robjects.r['Test_Idx'])
-          train_idx = robjects.conversion.rpy2py(robjects.r['Train_Idx'])
-          cells_to_keep = robjects.conversion.rpy2py(robjects.r['Cells_to_Keep'])
+        test_idx, train_idx, cells_to_keep = load_cv_folds(self.data_dir + "/" + self.data_name)
 
         # Step #1: Read in all labels and keep cells with count > 10
         cells_to_keep = np.array(cells_to_keep, dtype=bool)
@@ -542,66 +573,52 @@ class AMBDataModule(pl.LightningDataModule):
         int_labels = None
 
         # Step #3: Read in data based on selected label indices
-        data = pd.read_csv(DataPath, index_col=0, sep=',')
-        if self.feature_selection:
-          data = gene_selection(data)
-        full_data = np.asarray(data, dtype=np.float32)
-        full_data = full_data[cells_to_keep]
+        full_data, self.gene_names = load_expression_data(DataPath, self.feature_selection, cells_to_keep)
 
-        full_dataset = CustomDataset(data=full_data, labels=full_labels)
+        full_dataset = TensorBatchDataset(data=full_data, labels=full_labels)
         test_idx = np.array(test_idx[self.fold_num]) - 1
         train_idx = np.array(train_idx[self.fold_num]) - 1
 
-        self.AMB_test = Subset(full_dataset, test_idx)
+        self.AMB_test = full_dataset.subset(test_idx)
         self.AMB_train, self.AMB_val = split_train_val_database_sets(full_dataset, train_idx, train_percentage=0.75)
         print("train size =", len(self.AMB_train))
         print("val size =", len(self.AMB_val))
         print("test size =", len(self.AMB_test))
 
         # Calculate sample count in each class for training dataset
-        samples_in_each_class_dict = Counter([data[1] for data in self.AMB_train])
-        print("training samples in each class =", samples_in_each_class_dict)
-        samples_in_each_class_dict_val = Counter([data[1] for data in self.AMB_val])
-        print("val samples in each class =", samples_in_each_class_dict_val)
-        samples_in_each_class_dict_test = Counter([data[1] for data in self.AMB_test])
-        print("test samples in each class =", samples_in_each_class_dict_test)
-        self.N_CLASS = len(samples_in_each_class_dict)
-        print("Changing N_CLASS =", self.N_CLASS)
-        self.samples_in_each_class = torch.zeros(self.N_CLASS)
-        for index, count in samples_in_each_class_dict.items():
-           self.samples_in_each_class[index] = count
+        set_class_counts(self, self.AMB_train.labels, self.AMB_val.labels, self.AMB_test.labels)
 
     def train_dataloader(self):
-        return DataLoader(self.AMB_train, batch_size=self.batch_size,
-                          shuffle=True, num_workers=self.num_workers)
+        return batch_dataloader(self.AMB_train, batch_size=self.batch_size,
+                                shuffle=True, pin_memory=self.pin_memory)
 
     def val_dataloader(self):
-        return DataLoader(self.AMB_val, batch_size=self.batch_size,
-                          num_workers=self.num_workers)
+        return batch_dataloader(self.AMB_val, batch_size=self.batch_size,
+                                pin_memory=self.pin_memory)
 
     def test_dataloader(self):
-        return DataLoader(self.AMB_test, batch_size=self.batch_size,
-                          num_workers=self.num_workers)
+        return batch_dataloader(self.AMB_test, batch_size=self.batch_size,
+                                pin_memory=self.pin_memory)
 
 
 class XinDataModule(pl.LightningDataModule):
 
-    def __init__(self, data_dir: str = './data', batch_size=64, num_workers=2, fold_num=0, feature_selection=False):
+    def __init__(self, data_dir: str = './data', batch_size=64, num_workers=2, fold_num=0, feature_selection=False, pin_memory=False):
         super().__init__()
+        self.pin_memory = pin_memory
         self.data_dir = data_dir
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.data_name = "Xin"
         self.label_mapping = None
+        self.gene_names = None
         self.fold_num = fold_num # fold_num 可以是 0-4
         self.feature_selection = feature_selection
         self.N_FEATURES = 33889
 
         if feature_selection:
           DataPath = self.data_dir + "/" + self.data_name + "/Filtered_Xin_HumanPancreas_data.csv"
-          data = pd.read_csv(DataPath, index_col=0, sep=',')
-          data = gene_selection(data)
-          self.N_FEATURES = data.shape[1]
+          self.N_FEATURES = len(select_genes(DataPath))
 
     def prepare_data(self):
         # download
@@ -614,14 +631,10 @@ class XinDataModule(pl.LightningDataModule):
         # Assign train/val datasets for use in dataloaders
 
         DataPath = self.data_dir + "/" + self.data_name + "/Filtered_Xin_HumanPancreas_data.csv"
+        self.data_path = DataPath
         LabelsPath = self.data_dir + "/" + self.data_name + "/Labels.csv"
 
-        rf = robjects.r['load'](self.data_dir + "/" + self.data_name + "/CV_folds.RData")
-
-        with localconverter(robjects.default_converter + pandas2ri.converter):
-          test_idx = robjects.conversion.rpy2py(robjects.r['Test_Idx'])
-          train_idx = robjects.conversion.rpy2py(robjects.r['Train_Idx'])
-          cells_to_keep = robjects.conversion.rpy2py(robjects.r['Cells_to_Keep'])
+        test_idx, train_idx, cells_to_keep = load_cv_folds(self.data_dir + "/" + self.data_name)
 
         # Step #1: Read in all labels and keep cells with count > 10
         cells_to_keep = np.array(cells_to_keep, dtype=bool)
@@ -641,46 +654,32 @@ class XinDataModule(pl.LightningDataModule):
         int_labels = None
 
         # Step #3: Read in data based on selected label indices
-        data = pd.read_csv(DataPath, index_col=0, sep=',')
-        if self.feature_selection:
-          data = gene_selection(data)
-        full_data = np.asarray(data, dtype=np.float32)
-        full_data = full_data[cells_to_keep]
+        full_data, self.gene_names = load_expression_data(DataPath, self.feature_selection, cells_to_keep)
 
-        full_dataset = CustomDataset(data=full_data, labels=full_labels)
+        full_dataset = TensorBatchDataset(data=full_data, labels=full_labels)
         test_idx = np.array(test_idx[self.fold_num]) - 1
         train_idx = np.array(train_idx[self.fold_num]) - 1
 
-        self.Xin_test = Subset(full_dataset, test_idx)
+        self.Xin_test = full_dataset.subset(test_idx)
         self.Xin_train, self.Xin_val = split_train_val_database_sets(full_dataset, train_idx, train_percentage=0.75)
         print("train size =", len(self.Xin_train))
         print("val size =", len(self.Xin_val))
         print("test size =", len(self.Xin_test))
 
         # Calculate sample count in each class for training dataset
-        samples_in_each_class_dict = Counter([data[1] for data in self.Xin_train])
-        print("training samples in each class =", samples_in_each_class_dict)
-        samples_in_each_class_dict_val = Counter([data[1] for data in self.Xin_val])
-        print("val samples in each class =", samples_in_each_class_dict_val)
-        samples_in_each_class_dict_test = Counter([data[1] for data in self.Xin_test])
-        print("test samples in each class =", samples_in_each_class_dict_test)
-        self.N_CLASS = len(samples_in_each_class_dict)
-        print("Changing N_CLASS =", self.N_CLASS)
-        self.samples_in_each_class = torch.zeros(self.N_CLASS)
-        for index, count in samples_in_each_class_dict.items():
-           self.samples_in_each_class[index] = count
+        set_class_counts(self, self.Xin_train.labels, self.Xin_val.labels, self.Xin_test.labels)
 
     def train_dataloader(self):
-        return DataLoader(self.Xin_train, batch_size=self.batch_size,
-                          shuffle=True, num_workers=self.num_workers)
+        return batch_dataloader(self.Xin_train, batch_size=self.batch_size,
+                                shuffle=True, pin_memory=self.pin_memory)
 
     def val_dataloader(self):
-        return DataLoader(self.Xin_val, batch_size=self.batch_size,
-                          num_workers=self.num_workers)
+        return batch_dataloader(self.Xin_val, batch_size=self.batch_size,
+                                pin_memory=self.pin_memory)
 
     def test_dataloader(self):
-        return DataLoader(self.Xin_test, batch_size=self.batch_size,
-                          num_workers=self.num_workers)
+        return batch_dataloader(self.Xin_test, batch_size=self.batch_size,
+                                pin_memory=self.pin_memory)
 
 
 class FetalDataModule(pl.LightningDataModule):
@@ -692,6 +691,7 @@ class FetalDataModule(pl.LightningDataModule):
         self.num_workers = num_workers
         self.data_name = "Fetal"
         self.label_mapping = None
+        self.gene_names = None
 
     def prepare_data(self):
         # download
@@ -701,6 +701,7 @@ class FetalDataModule(pl.LightningDataModule):
 
     def setup(self, stage):
         DataPath = self.data_dir + "/" + self.data_name + "/sparse_matrix.npz"
+        self.data_path = DataPath
         LabelsPath = self.data_dir + "/" + self.data_name + "/type.csv"
 
         # Step #1: Read in all cells and labels
@@ -739,40 +740,33 @@ class FetalDataModule(pl.LightningDataModule):
         print("val size =", len(self.Fetal_val))
 
         # Calculate sample count in each class for training dataset
-        samples_in_each_class_dict = Counter([data[1] for data in self.Fetal_train])
-        print("training samples in each class =", samples_in_each_class_dict)
-        samples_in_each_class_dict_val = Counter([data[1] for data in self.Fetal_val])
-        print("val samples in each class =", samples_in_each_class_dict_val)
-
-        self.N_CLASS = len(samples_in_each_class_dict)
-        print("Changing N_CLASS =", self.N_CLASS)
-        self.samples_in_each_class = torch.zeros(self.N_CLASS)
-        for index, count in samples_in_each_class_dict.items():
-           self.samples_in_each_class[index] = count
+        set_class_counts(self, self.Fetal_train.labels, self.Fetal_val.labels)
 
 
     def train_dataloader(self):
-        return DataLoader(self.Fetal_train, batch_size=self.batch_size,
-                          shuffle=True, num_workers=self.num_workers)
+        return batch_dataloader(self.Fetal_train, batch_size=self.batch_size,
+                                shuffle=True, num_workers=self.num_workers)
 
     def val_dataloader(self):
-        return DataLoader(self.Fetal_val, batch_size=self.batch_size,
-                          num_workers=self.num_workers)
+        return batch_dataloader(self.Fetal_val, batch_size=self.batch_size,
+                                num_workers=self.num_workers)
 
     def test_dataloader(self):
-        return DataLoader(self.Fetal_val, batch_size=self.batch_size,
-                          num_workers=self.num_workers)                         
+        return batch_dataloader(self.Fetal_val, batch_size=self.batch_size,
+                                num_workers=self.num_workers)
 
 
 class Pbmc68kDataModule(pl.LightningDataModule):
 
-    def __init__(self, data_dir: str = './data', batch_size=128, num_workers=2, fold_num=0, feature_selection=False):
+    def __init__(self, data_dir: str = './data', batch_size=128, num_workers=2, fold_num=0, feature_selection=False, pin_memory=False):
         super().__init__()
+        self.pin_memory = pin_memory
         self.data_dir = data_dir
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.data_name = "pbmc68k"
         self.label_mapping = None
+        self.gene_names = None
         self.fold_num = fold_num # fold_num 可以是 0-4
         self.feature_selection = feature_selection
         self.N_FEATURES = 1000
@@ -785,6 +779,7 @@ class Pbmc68kDataModule(pl.LightningDataModule):
 
     def setup(self, stage):
         DataPath = self.data_dir + "/" + self.data_name + "/zheng68k.csv"
+        self.data_path = DataPath
         LabelsPath = self.data_dir + "/" + self.data_name + "/Labels.csv"
         DataSplitPath = self.data_dir + "/" + self.data_name + "/pbmc68k_split.npz"
 
@@ -808,8 +803,7 @@ class Pbmc68kDataModule(pl.LightningDataModule):
         print("Label name to integer mappings:", label_mapping_dict)
 
         # Step #3: Read in all data
-        data = pd.read_csv(DataPath, index_col=0, sep=',')
-        full_data = np.asarray(data, dtype=np.float32)
+        full_data, self.gene_names = load_expression_data(DataPath)
         print(full_data.shape)
        
         
@@ -819,38 +813,25 @@ class Pbmc68kDataModule(pl.LightningDataModule):
         test_idx = datasplit['test_idx']
 
         #x_train, x_val, y_train, y_val = train_test_split(full_data, full_labels, test_size=0.2, random_state=11, stratify=full_labels)
-        x_train = full_data[train_idx[self.fold_num]]
-        x_test = full_data[test_idx[self.fold_num]]
-        y_train = full_labels[train_idx[self.fold_num]]
-        y_test = full_labels[test_idx[self.fold_num]]
-
-        self.pbmc_train = CustomDataset(data=x_train, labels=y_train)
-        self.pbmc_test = CustomDataset(data=x_test, labels=y_test)
+        full_dataset = TensorBatchDataset(data=full_data, labels=full_labels)
+        self.pbmc_train = full_dataset.subset(train_idx[self.fold_num])
+        self.pbmc_test = full_dataset.subset(test_idx[self.fold_num])
 
         print("train size =", len(self.pbmc_train))
         print("test size =", len(self.pbmc_test))
 
         # Calculate sample count in each class for training dataset
-        samples_in_each_class_dict = Counter([data[1] for data in self.pbmc_train])
-        print("training samples in each class =", samples_in_each_class_dict)
-        samples_in_each_class_dict_val = Counter([data[1] for data in self.pbmc_test])
-        print("test samples in each class =", samples_in_each_class_dict_val)
-
-        self.N_CLASS = len(samples_in_each_class_dict)
-        print("Changing N_CLASS =", self.N_CLASS)
-        self.samples_in_each_class = torch.zeros(self.N_CLASS)
-        for index, count in samples_in_each_class_dict.items():
-           self.samples_in_each_class[index] = count
+        set_class_counts(self, self.pbmc_train.labels, test_labels=self.pbmc_test.labels)
 
 
     def train_dataloader(self):
-        return DataLoader(self.pbmc_train, batch_size=self.batch_size,
-                          shuffle=True, num_workers=self.num_workers)
+        return batch_dataloader(self.pbmc_train, batch_size=self.batch_size,
+                                shuffle=True, pin_memory=self.pin_memory)
 
     def val_dataloader(self):
-        return DataLoader(self.pbmc_test, batch_size=self.batch_size,
-                          num_workers=self.num_workers)
+        return batch_dataloader(self.pbmc_test, batch_size=self.batch_size,
+                                pin_memory=self.pin_memory)
 
     def test_dataloader(self):
-        return DataLoader(self.pbmc_test, batch_size=self.batch_size,
-                          num_workers=self.num_workers)     
\ No newline at end of file
+        return batch_dataloader(self.pbmc_test, batch_size=self.batch_size,
+                                pin_memory=self.pin_memory)     
\ No newline at end of file
@@ -0,0 +1,410 @@
+import numpy as np
+
+###------------------------------Packed hash codes---------------------------------###
+# Hash codes are stored as bits packed into uint64 words: a 64-bit code takes
+# one word per cell, a 128-bit code two words, and so on. A bit is set when the
+# corresponding code entry is positive, so tanh outputs, sign() outputs and the
+# +1/-1 cell anchors all pack the same way.
+
+# Number of set bits for every possible byte, used when np.bitwise_count is unavailable
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+# Upper bound on the size (in uint64 words) of the XOR buffer built for a block of queries
+_MAX_BLOCK_WORDS = 1 << 24
+
+# Upper bound on the bytes held while ranking a block of queries against the whole database.
+# Bytes per (query, database entry) at the peak of a ranking: int32 distances (4) and their
+# uint8 copy (1), plus the largest of
+# - the intp histogram keys of the single np.bincount (8)
+# - the candidate mask and, when every entry ties at the threshold distance, the candidate
+#   arrays of the cut-off: int64 rows and columns, tie flags and ranks, row offsets (1 + 34)
+# - the int64 order and gathered int32 distances of a full ranking (12)
+_MAX_RANK_BYTES = 1 << 28
+_RANK_BYTES_PER_ENTRY = 40
+# bytes per (query, distance value): int64 histogram and its cumulative sum
+_RANK_BYTES_PER_BIN = 16
+
+
+def n_words(bit):
+    # number of uint64 words needed to hold a bit-length code
+    return (bit + 63) // 64
+
+
+def pack_binaries(binaries):
+    ''' Pack real-valued codes of shape (n, bit) or (bit,) into uint64 words.
+    Returns an array of shape (n, n_words(bit)) or (n_words(bit),).
+    '''
+    binaries = np.asarray(binaries)
+    single = binaries.ndim == 1
+    binaries = np.atleast_2d(binaries)
+    bit = binaries.shape[1]
+
+    packed_bytes = np.packbits(binaries > 0, axis=1, bitorder='little')
+    # pad every row to a whole number of 64-bit words
+    padded = np.zeros((binaries.shape[0], n_words(bit) * 8), dtype=np.uint8)
+    padded[:, :packed_bytes.shape[1]] = packed_bytes
+    packed = padded.view('<u8').astype(np.uint64, copy=False)
+    return packed[0] if single else packed
+
+
+def as_packed(codes):
+    # codes that are already packed (uint64) are passed through, others are packed
+    codes = np.asarray(codes)
+    return codes if codes.dtype == np.uint64 else pack_binaries(codes)
+
+
+def unpack_binaries(packed, bit):
+    # inverse of pack_binaries, returns +1/-1 float32 codes
+    packed = np.asarray(packed, dtype=np.uint64)
+    single = packed.ndim == 1
+    packed = np.atleast_2d(packed)
+    bits = np.unpackbits(np.ascontiguousarray(packed.astype('<u8')).view(np.uint8),
+                         axis=1, count=bit, bitorder='little')
+    codes = bits.astype(np.float32) * 2 - 1
+    return codes[0] if single else codes
+
+
+def popcount(words):
+    # count set bits of every uint64 entry
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words).astype(np.int32)
+    words = np.ascontiguousarray(words, dtype=np.uint64)
+    counts = _POPCOUNT_TABLE[words.view(np.uint8)]
+    return counts.reshape(words.shape + (8,)).sum(axis=-1, dtype=np.int32)
+
+
+def calc_hamming_dist_packed(query_packed, database_packed):
+    ''' XOR + popcount Hamming distance on packed codes.
+    query_packed: (n_words,) for a single query or (q, n_words) for a batch
+    database_packed: (n, n_words)
+    Returns int32 distances of shape (n,) or (q, n).
+    '''
+    query_packed = np.asarray(query_packed, dtype=np.uint64)
+    database_packed = np.asarray(database_packed, dtype=np.uint64)
+    if query_packed.ndim == 1:
+        return popcount(database_packed ^ query_packed).sum(axis=1, dtype=np.int32)
+
+    num_query, num_database = query_packed.shape[0], database_packed.shape[0]
+    words = database_packed.shape[1]
+    dists = np.empty((num_query, num_database), dtype=np.int32)
+    # process queries in blocks so the XOR buffer stays bounded
+    block = max(1, _MAX_BLOCK_WORDS // max(1, num_database * words))
+    for start in range(0, num_query, block):
+        xor = query_packed[start:start + block, None, :] ^ database_packed[None, :, :]
+        dists[start:start + block] = popcount(xor).sum(axis=2, dtype=np.int32)
+    return dists
+
+
+###------------------------------Ranking by Hamming distance---------------------------------###
+# Hamming distances are integers in [0, bit], so a ranking is a counting sort: bucket the
+# entries by distance, keeping database order inside every bucket. With distances cast to
+# uint8/uint16, numpy's stable argsort is an LSD radix sort, i.e. this counting sort,
+# in O(N + bit) per query. Every function below breaks ties by database index, so they
+# all produce the prefix of the same stable ranking.
+
+def _small_dists(dists, max_dist=None):
+    # distances as the smallest unsigned type holding max_dist, None when they do not fit 16 bits
+    dists = np.asarray(dists)
+    if max_dist is None:
+        max_dist = int(dists.max()) if dists.size else 0
+    if max_dist < 256:
+        return dists.astype(np.uint8, copy=False), max_dist
+    if max_dist < 65536:
+        return dists.astype(np.uint16, copy=False), max_dist
+    return None, max_dist
+
+
+def rank_by_distance(dists, max_dist=None):
+    ''' Stable ranking of a (n,) or (q, n) distance array along its last axis.
+    max_dist: upper bound of the distances (the bit length), computed when omitted
+    Returns the indices sorted by distance, ties by index.
+    '''
+    small, _ = _small_dists(dists, max_dist)
+    if small is None:
+        return np.argsort(dists, axis=-1, kind='stable')
+    return np.argsort(small, axis=-1, kind='stable')
+
+
+def topk_by_distance(dists, k, max_dist=None):
+    ''' k smallest entries of every row of a (q, n) distance array, found with a distance
+    histogram: all entries below the threshold distance plus the first entries at it.
+    Returns (indices, dists) of shape (q, k) sorted by distance, ties by index.
+    '''
+    dists = np.atleast_2d(dists)
+    num_query, num_database = dists.shape
+    if k >= num_database:
+        indexes = rank_by_distance(dists, max_dist)
+        return indexes, np.take_along_axis(dists, indexes, axis=1)
+    small, max_dist = _small_dists(dists, max_dist)
+    if small is None:
+        return topk_rank(dists, k)
+    rows = np.arange(num_query)
+    # histograms of all rows with one bincount over row * (max_dist + 1) + distance
+    keys = small.astype(np.intp)
+    keys += rows[:, None] * (max_dist + 1)
+    hist = np.bincount(keys.ravel(), minlength=num_query * (max_dist + 1)).reshape(num_query, max_dist + 1)
+    del keys
+    cumulative = np.cumsum(hist, axis=1)
+    # threshold: smallest distance reaching k entries, and how many entries at it are kept
+    threshold = np.argmax(cumulative >= k, axis=1)
+    needed = k - (cumulative[rows, threshold] - hist[rows, threshold])
+    # candidates: every entry up to the threshold distance, in index order within each row
+    cand_rows, cand_cols = np.nonzero(small <= threshold.astype(small.dtype)[:, None])
+    # keep entries below the threshold and the first needed entries at it
+    ties = small[cand_rows, cand_cols] == threshold[cand_rows]
+    tie_rank = np.cumsum(ties)
+    row_starts = np.concatenate(([0], np.cumsum(cumulative[rows, threshold])[:-1]))
+    tie_rank -= np.concatenate(([0], tie_rank))[row_starts][cand_rows]
+    selected = cand_cols[~ties | (tie_rank <= needed[cand_rows])]
+    # selected entries come out in index order, a stable sort by distance finishes the ranking
+    candidates = selected.reshape(num_query, k)
+    order = np.argsort(np.take_along_axis(small, candidates, axis=1), axis=1, kind='stable')
+    indexes = np.take_along_axis(candidates, order, axis=1)
+    return indexes, np.take_along_axis(dists, indexes, axis=1)
+
+
+###------------------------------Top-K search---------------------------------###
+# Partial selection: distances of a block of queries are computed at once, argpartition
+# keeps the k closest entries of every query and only those k are sorted. Keys
+# dist * N + index are unique, so ties are broken by database index exactly as in a
+# stable full sort. topk_blocks uses the histogram cut-off above, this is the fallback
+# for distances that do not fit 16 bits.
+
+def topk_rank(dists, k, max_dist=None):
+    # indices and distances of the k closest entries of every row of a (q, n) distance block
+    num_database = dists.shape[1]
+    if k >= num_database:
+        indexes = rank_by_distance(dists, max_dist)
+    else:
+        keys = dists.astype(np.int64) * num_database + np.arange(num_database)
+        candidates = np.argpartition(keys, k - 1, axis=1)[:, :k]
+        order = np.argsort(np.take_along_axis(keys, candidates, axis=1), axis=1)
+        indexes = np.take_along_axis(candidates, order, axis=1)
+    return indexes, np.take_along_axis(dists, indexes, axis=1)
+
+
+def query_block_size(num_database, bytes_per_query=0, num_workers=1, max_dist=64):
+    ''' Queries per block so the distances and ranking buffers of the blocks in flight stay
+    within _MAX_RANK_BYTES.
+    bytes_per_query: what the caller holds per query on top of the ranking buffers
+    num_workers: blocks processed at the same time, the budget is shared between them
+    max_dist: largest distance (the bit length), sizes the per-query histograms
+    '''
+    per_query = num_database * _RANK_BYTES_PER_ENTRY + (max_dist + 1) * _RANK_BYTES_PER_BIN + bytes_per_query
+    return max(1, _MAX_RANK_BYTES // num_workers // max(1, per_query))
+
+
+def topk_blocks(query_packed, database_packed, k, block_size=None):
+    ''' Yields (start, indices, dists) for consecutive blocks of queries, where indices and
+    dists are (block, k) arrays of the k nearest database entries sorted by distance,
+    ties by database index. k < 0 or k >= len(database) returns the full ranking.
+    block_size: queries per block, by default sized from the database under _MAX_RANK_BYTES
+    '''
+    query_packed = np.atleast_2d(np.asarray(query_packed, dtype=np.uint64))
+    database_packed = np.asarray(database_packed, dtype=np.uint64)
+    num_database = database_packed.shape[0]
+    k = num_database if k < 0 else min(k, num_database)
+    max_dist = 64 * database_packed.shape[1]
+    if block_size is None:
+        block_size = query_block_size(num_database, max_dist=max_dist)
+    for start in range(0, query_packed.shape[0], block_size):
+        dists = calc_hamming_dist_packed(query_packed[start:start + block_size], database_packed)
+        indices, block_dists = topk_by_distance(dists, k, max_dist)
+        yield start, indices, block_dists
+
+
+def hamming_topk(query_packed, database_packed, k, block_size=None):
+    # (indices, dists) of shape (q, k) for all queries at once, see topk_blocks
+    blocks = list(topk_blocks(query_packed, database_packed, k, block_size))
+    if not blocks:
+        return np.empty((0, 0), dtype=np.int64), np.empty((0, 0), dtype=np.int32)
+    return np.concatenate([b[1] for b in blocks]), np.concatenate([b[2] for b in blocks])
+
+
+###------------------------------Cell anchor annotation---------------------------------###
+
+def annotate_closest_cell_anchor(query_binaries, cell_anchors, chunk_size=65536):
+    ''' Label every query with its closest cell anchor in one vectorized pass.
+    query_binaries: (n, bit) real-valued or +1/-1 codes
+    cell_anchors: (n_class, bit) +1/-1 anchors
+    Returns
+    - labels_pred: index of the closest anchor for every query
+    - nearest_dists: Hamming distance to that anchor
+    - margins: distance to the runner-up anchor minus nearest_dists (0 means a tie)
+    '''
+    anchors_packed = pack_binaries(cell_anchors)
+    num_query = len(query_binaries)
+    labels_pred = np.empty(num_query, dtype=np.int64)
+    nearest_dists = np.empty(num_query, dtype=np.int32)
+    margins = np.zeros(num_query, dtype=np.int32)
+    for start in range(0, num_query, chunk_size):
+        end = start + chunk_size
+        dists = calc_hamming_dist_packed(pack_binaries(query_binaries[start:end]), anchors_packed)
+        labels_pred[start:end] = np.argmin(dists, axis=1)
+        if dists.shape[1] > 1:
+            two_smallest = np.partition(dists, 1, axis=1)[:, :2]
+            nearest_dists[start:end] = two_smallest[:, 0]
+            margins[start:end] = two_smallest[:, 1] - two_smallest[:, 0]
+        else:
+            nearest_dists[start:end] = dists[:, 0]
+    return labels_pred, nearest_dists, margins
+
+
+###------------------------------Multi-index hashing---------------------------------###
+# Reference Paper: Norouzi et al., Fast Exact Search in Hamming Space with Multi-Index Hashing
+# https://arxiv.org/abs/1307.2982
+# Codes are split into m disjoint substrings. If two codes are within Hamming distance r,
+# at least one of their substrings is within distance floor(r / m) (pigeonhole), so only
+# database entries sharing a nearby substring need a full distance computation.
+
+def _substring_values(packed, bit, bounds, chunk_size=1 << 20):
+    # integer value of every substring [a, b) of every code, shape (n, len(bounds))
+    values = np.empty((packed.shape[0], len(bounds)), dtype=np.uint64)
+    for start in range(0, packed.shape[0], chunk_size):
+        chunk = np.ascontiguousarray(packed[start:start + chunk_size].astype('<u8'))
+        bits = np.unpackbits(chunk.view(np.uint8), axis=1, count=bit, bitorder='little')
+        for i, (a, b) in enumerate(bounds):
+            weights = np.left_shift(np.uint64(1), np.arange(b - a, dtype=np.uint64))
+            values[start:start + chunk_size, i] = (bits[:, a:b].astype(np.uint64) * weights).sum(axis=1, dtype=np.uint64)
+    return values
+
+
+# Below this many codes a brute-force scan is faster than probing the tables
+MIH_MIN_DATABASE = 1 << 18
+# A query falls back to a brute-force scan once its table lookups or candidates exceed these
+# fractions of the database: probing them costs more than scanning every code (spread-out codes)
+MIH_MAX_PROBE_FRACTION = 0.005
+MIH_MAX_CANDIDATE_FRACTION = 0.05
+
+
+def _comb(n, k):
+    # binomial coefficient, 0 when k > n
+    if k > n:
+        return 0
+    result = 1
+    for i in range(k):
+        result = result * (n - i) // (i + 1)
+    return result
+
+
+def mih_substrings(bit, num_database):
+    # substrings of about log2(N) bits keep about one database entry per table bucket
+    return int(min(bit, max(1, round(bit / np.log2(max(num_database, 2))))))
+
+
+class MultiIndexHashing:
+    ''' Exact kNN and radius search over packed hash codes. Small databases, and queries
+    whose candidate set grows too large, are answered with a brute-force scan instead.
+    '''
+
+    # cache of XOR masks flipping exactly s bits of a length-L substring, keyed by (L, s)
+    _flip_masks = {}
+
+    def __init__(self, database_packed, bit, n_substrings=None):
+        self.database_packed = np.asarray(database_packed, dtype=np.uint64)
+        self.bit = bit
+        if n_substrings is None:
+            n_substrings = mih_substrings(bit, len(self.database_packed))
+        self.n_substrings = n_substrings
+        self.brute_force = len(self.database_packed) < MIH_MIN_DATABASE
+        self.max_probes = int(MIH_MAX_PROBE_FRACTION * len(self.database_packed))
+        self.max_candidates = int(MIH_MAX_CANDIDATE_FRACTION * len(self.database_packed))
+        if self.brute_force:
+            self.bounds, self.table_ids, self.table_values = [], [], []
+            return
+        edges = np.linspace(0, bit, n_substrings + 1).round().astype(int)
+        self.bounds = list(zip(edges[:-1], edges[1:]))
+
+        # one table per substring: database ids sorted by substring value
+        values = _substring_values(self.database_packed, bit, self.bounds)
+        self.table_ids, self.table_values = [], []
+        for i in range(n_substrings):
+            order = np.argsort(values[:, i], kind='stable')
+            self.table_ids.append(order)
+            self.table_values.append(values[order, i])
+
+    def __len__(self):
+        return self.database_packed.shape[0]
+
+    @classmethod
+    def get_flip_masks(cls, length, s):
+        key = (length, s)
+        if key not in cls._flip_masks:
+            from itertools import combinations
+            masks = [sum(1 << j for j in flipped) for flipped in combinations(range(length), s)]
+            cls._flip_masks[key] = np.array(masks, dtype=np.uint64)
+        return cls._flip_masks[key]
+
+    def _probe(self, query_values, s):
+        # database ids whose substring i is at distance exactly s from the query, over all i
+        found = []
+        for i, (a, b) in enumerate(self.bounds):
+            if s > b - a:
+                continue
+            keys = query_values[i] ^ self.get_flip_masks(b - a, s)
+            lo = np.searchsorted(self.table_values[i], keys, side='left')
+            hi = np.searchsorted(self.table_values[i], keys, side='right')
+            counts = hi - lo
+            total = counts.sum()
+            if total == 0:
+                continue
+            # expand every [lo, hi) range into table positions
+            offsets = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(total)
+            found.append(self.table_ids[i][offsets])
+        if not found:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(found))
+
+    def _search(self, query_packed, max_s, stop):
+        # (ids, dists) of the checked candidates sorted by distance, None when a scan is cheaper
+        query_packed = np.asarray(query_packed, dtype=np.uint64)
+        query_values = _substring_values(query_packed[None, :], self.bit, self.bounds)[0]
+        checked = np.empty(0, dtype=np.int64)
+        ids, dists = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32)
+        probes = 0
+        for s in range(max_s + 1):
+            probes += sum(_comb(b - a, s) for a, b in self.bounds)
+            if probes > self.max_probes:
+                return None
+            candidates = np.setdiff1d(self._probe(query_values, s), checked, assume_unique=True)
+            if checked.size + candidates.size > self.max_candidates:
+                return None
+            if candidates.size:
+                checked = np.union1d(checked, candidates)
+                ids = np.concatenate([ids, candidates])
+                dists = np.concatenate([dists, calc_hamming_dist_packed(query_packed, self.database_packed[candidates])])
+            # every code within this distance has now been checked
+            covered_radius = self.n_substrings * (s + 1) - 1
+            if stop(dists, covered_radius):
+                break
+        order = np.lexsort((ids, dists))
+        return ids[order], dists[order]
+
+    def radius_search(self, query_packed, radius):
+        ''' All database entries within Hamming distance radius of the query.
+        Returns (indices, dists) sorted by distance, ties by database index.
+        '''
+        found = None if self.brute_force else \
+            self._search(query_packed, radius // self.n_substrings, lambda dists, covered: False)
+        if found is None:
+            dists = calc_hamming_dist_packed(query_packed, self.database_packed)
+            ids = np.flatnonzero(dists <= radius)
+            order = rank_by_distance(dists[ids], self.bit)
+            return ids[order], dists[ids[order]]
+        ids, dists = found
+        keep = dists <= radius
+        return ids[keep], dists[keep]
+
+    def knn(self, query_packed, k):
+        ''' Exact k nearest neighbours of the query.
+        Returns (indices, dists) sorted by distance, ties by database index.
+        '''
+        k = min(k, len(self))
+        found = None if self.brute_force else \
+            self._search(query_packed, max(b - a for a, b in self.bounds),
+                         lambda dists, covered: np.count_nonzero(dists <= covered) >= k)
+        if found is None:
+            ids, dists = hamming_topk(query_packed, self.database_packed, k)
+            return ids[0], dists[0]
+        ids, dists = found
+        return ids[:k], dists[:k]
@@ -0,0 +1,104 @@
+import json
+import numpy as np
+
+from hamming import n_words
+
+###------------------------------Binary hash code database---------------------------------###
+# File layout:
+#   8 bytes   magic
+#   8 bytes   little-endian uint64, length of the JSON header
+#   header    JSON: bit width, cell count, anchor matrix, label mapping and array table
+#   arrays    packed codes, labels and cell IDs, each aligned to 64 bytes from the
+#             start of the data section (the first 64-byte boundary after the header)
+# Arrays are opened with np.memmap, so loading only reads the header and several
+# query processes share the same pages of the OS cache.
+
+MAGIC = b'SCDHDB01'
+_ALIGNMENT = 64
+
+
+def _align(offset):
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+class HashDatabase:
+    'Memory-mapped view of a hash code database file'
+
+    def __init__(self, path, mode='r'):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{} is not a hash code database".format(path))
+            header_len = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+            header = json.loads(f.read(header_len).decode('utf-8'))
+        data_start = _align(len(MAGIC) + 8 + header_len)
+
+        self.header = header
+        self.bit = header['bit']
+        self.n_cells = header['n_cells']
+        self.cell_anchors = None if header['cell_anchors'] is None else np.array(header['cell_anchors'], dtype=np.float32)
+        self.label_mapping = header['label_mapping']
+        self.metadata = header.get('metadata', {})
+
+        arrays = {}
+        for name, spec in header['arrays'].items():
+            shape = tuple(spec['shape'])
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.empty(shape, dtype=spec['dtype'])
+            else:
+                arrays[name] = np.memmap(path, dtype=spec['dtype'], mode=mode,
+                                         offset=data_start + spec['offset'], shape=shape)
+        self.codes = arrays['codes']
+        self.labels = arrays['labels']
+        self.cell_ids = arrays.get('cell_ids')
+
+    def __len__(self):
+        return self.n_cells
+
+
+def save_hash_database(path, packed_codes, bit, labels=None, cell_ids=None, cell_anchors=None, label_mapping=None, metadata=None):
+    ''' Write packed codes (see hamming.pack_binaries) and their labels to a database file.
+    labels: integer class ids, -1 when unknown
+    cell_ids: optional cell names
+    cell_anchors: optional (n_class, bit) anchor matrix
+    label_mapping: optional list of class names, indexed by label
+    metadata: optional JSON-serializable dict stored in the header
+    '''
+    packed_codes = np.ascontiguousarray(packed_codes, dtype='<u8')
+    n_cells = packed_codes.shape[0]
+    assert packed_codes.shape[1] == n_words(bit)
+    if labels is None:
+        labels = np.full(n_cells, -1)
+    arrays = {'codes': packed_codes,
+              'labels': np.ascontiguousarray(labels, dtype='<i4').ravel()}
+    if cell_ids is not None:
+        arrays['cell_ids'] = np.asarray([str(cell_id) for cell_id in cell_ids]).astype('S')
+    for name, array in arrays.items():
+        assert array.shape[0] == n_cells, "{} has {} rows, expected {}".format(name, array.shape[0], n_cells)
+
+    array_specs, offset = {}, 0
+    for name, array in arrays.items():
+        array_specs[name] = {'offset': offset, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+        offset = _align(offset + array.nbytes)
+
+    header = {'version': 1,
+              'bit': int(bit),
+              'n_cells': int(n_cells),
+              'cell_anchors': None if cell_anchors is None else np.asarray(cell_anchors).tolist(),
+              'label_mapping': None if label_mapping is None else [str(name) for name in label_mapping],
+              'metadata': metadata or {},
+              'arrays': array_specs}
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = _align(len(MAGIC) + 8 + len(header_bytes))
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.array([len(header_bytes)], dtype='<u8').tobytes())
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + array_specs[name]['offset'])
+            f.write(array.tobytes())
+
+
+def open_hash_database(path):
+    return HashDatabase(path)
@@ -0,0 +1,164 @@
+import copy
+import numpy as np
+import torch
+from torch import nn
+
+from anchors import get_cell_anchors
+
+###------------------------------Hash encoder (inference only)---------------------------------###
+# Model definition and inference helpers shared by the Lightning training module
+# (scDeepHash.scDeepHashModel) and inference-only code. This module only depends on
+# torch, numpy and scipy.linalg (anchors), so encoding cells does not import
+# Lightning, sklearn, torchvision or the data modules.
+
+
+def build_hash_layer(n_features, bit, n_layers=5):
+    if n_layers == 5:
+        return nn.Sequential(
+            nn.Linear(n_features, 9000),
+            nn.ReLU(inplace=True),
+            nn.Dropout(0.2),
+            nn.Linear(9000, 3150),
+            nn.ReLU(inplace=True),
+            nn.Dropout(0.2),
+            nn.Linear(3150, 900),
+            nn.ReLU(inplace=True),
+            nn.Dropout(0.2),
+            nn.Linear(900, 450),
+            nn.ReLU(inplace=True),
+            nn.Linear(450, 200),
+            nn.ReLU(inplace=True),
+            nn.Linear(200, bit),
+        )
+    elif n_layers == 4:
+        return nn.Sequential(
+            nn.Linear(n_features, 5000),
+            nn.ReLU(inplace=True),
+            nn.Dropout(0.2),
+            nn.Linear(5000, 2000),
+            nn.ReLU(inplace=True),
+            nn.Dropout(0.2),
+            nn.Linear(2000, 800),
+            nn.ReLU(inplace=True),
+            nn.Linear(800, 300),
+            nn.ReLU(inplace=True),
+            nn.Linear(300, bit),
+        )
+    elif n_layers == 3:
+        return nn.Sequential(
+            nn.Linear(n_features, 4000),
+            nn.ReLU(inplace=True),
+            nn.Dropout(),
+            nn.Linear(4000, 1000),
+            nn.ReLU(inplace=True),
+            nn.Linear(1000, 250),
+            nn.ReLU(inplace=True),
+            nn.Linear(250, bit),
+        )
+    raise ValueError("Unsupported n_layers: {}".format(n_layers))
+
+
+def hash_forward(hash_layer, x):
+    if x.is_sparse:
+        first_layer = hash_layer[0]
+        if not isinstance(first_layer, nn.Linear):
+            # quantized layers only take dense input
+            return hash_layer(x.to_dense())
+        # sparse batches (SparseCustomDataset) go through a sparse-dense matmul in the first layer
+        x = torch.sparse.addmm(first_layer.bias.unsqueeze(0).expand(x.shape[0], -1), x, first_layer.weight.t())
+        return hash_layer[1:](x)
+    return hash_layer(x)
+
+
+# convert one chunk of expression data (ndarray, tensor or scipy sparse matrix) to a model input
+def to_input_tensor(batch):
+    if torch.is_tensor(batch):
+        return batch.float() if not batch.is_sparse else batch
+    if hasattr(batch, "tocoo"):
+        batch = batch.tocoo()
+        indices = torch.from_numpy(np.vstack((batch.row, batch.col)).astype(np.int64))
+        return torch.sparse_coo_tensor(indices, torch.from_numpy(batch.data.astype(np.float32)), batch.shape)
+    return torch.from_numpy(np.ascontiguousarray(batch, dtype=np.float32))
+
+
+def module_device(module):
+    # quantized modules have no parameters and run on CPU
+    parameter = next(module.parameters(), None)
+    return parameter.device if parameter is not None else torch.device('cpu')
+
+
+def encode_batches(model, data, batch_size=1024, device=None, num_threads=None):
+    ''' Yields tanh hash codes (on CPU) of model for consecutive chunks of data.
+    data: anything with rows that can be sliced (ndarray, memmap, tensor, scipy sparse matrix),
+          or an iterable of batches
+    device: device to run on, defaults to the device the model is on
+    num_threads: intra-op thread count used while encoding
+    Runs under torch.inference_mode in eval mode; the model's device, mode and the
+    thread count are restored once the generator is exhausted or closed.
+    '''
+    original_device, was_training = module_device(model), model.training
+    original_threads = torch.get_num_threads()
+    device = torch.device(device) if device is not None else original_device
+    if hasattr(data, "shape"):
+        batches = (data[start:start + batch_size] for start in range(0, data.shape[0], batch_size))
+    else:
+        batches = iter(data)
+    try:
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        model.to(device)
+        model.eval()
+        with getattr(torch, 'inference_mode', torch.no_grad)():
+            for batch in batches:
+                yield model(to_input_tensor(batch).to(device)).tanh().cpu()
+    finally:
+        model.train(was_training)
+        model.to(original_device)
+        torch.set_num_threads(original_threads)
+
+
+###------------------------------Dynamic int8 quantization---------------------------------###
+# Linear weights are stored as int8 with one scale per output channel, activations are
+# quantized on the fly, so no calibration data or retraining is needed. Quantized layers
+# only run on CPU.
+
+def quantize_hash_layer(hash_layer):
+    hash_layer = copy.deepcopy(hash_layer).cpu().eval()
+    return torch.quantization.quantize_dynamic(
+        hash_layer, {nn.Linear: torch.quantization.per_channel_dynamic_qconfig}, dtype=torch.qint8)
+
+
+class HashEncoder(nn.Module):
+    'Hash layer and cell anchors of a trained model, without the training logic'
+
+    def __init__(self, n_class, n_features, bit=64, n_layers=5, anchor_seed=0):
+        super(HashEncoder, self).__init__()
+        self.n_class = n_class
+        self.bit = bit
+        self.n_layers = n_layers
+        self.cell_anchors = get_cell_anchors(n_class, bit, seed=anchor_seed)
+        self.hash_layer = build_hash_layer(n_features, bit, n_layers)
+
+    def forward(self, x):
+        return hash_forward(self.hash_layer, x)
+
+    def encode(self, data, batch_size=1024, device=None, num_threads=None):
+        return encode_batches(self, data, batch_size, device, num_threads)
+
+    def quantize(self):
+        # dynamic int8 hash layer for CPU inference
+        self.cpu()
+        self.hash_layer = quantize_hash_layer(self.hash_layer)
+        return self
+
+
+def load_encoder(checkpoint_path, n_class, n_features, bit=64, n_layers=5, anchor_seed=0):
+    ''' Load the hash layer of a scDeepHashModel Lightning checkpoint into a HashEncoder
+    without importing Lightning. Optimizer state and hyperparameters are ignored.
+    '''
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    state_dict = checkpoint.get('state_dict', checkpoint)
+    encoder = HashEncoder(n_class, n_features, bit=bit, n_layers=n_layers, anchor_seed=anchor_seed)
+    encoder.load_state_dict({key: value for key, value in state_dict.items() if key.startswith('hash_layer.')})
+    encoder.eval()
+    return encoder
@@ -0,0 +1,147 @@
+import numpy as np
+
+###------------------------------Confusion matrix metric engine---------------------------------###
+# All labeling metrics reported by compute_metrics are derived from one integer
+# confusion matrix (rows: true labels, columns: predicted labels). The matrix is
+# built with a single bincount and can be accumulated over chunks of queries or
+# merged across workers. Definitions follow sklearn.metrics:
+# - averaged precision / recall / F1 only use labels present in y_true or y_pred
+# - ill-defined precision / recall / F1 (zero denominators) are set to 0
+# - classification_report lists every class and averages over all of them
+
+
+def _divide(numerator, denominator):
+    numerator, denominator = np.asarray(numerator, dtype=np.float64), np.asarray(denominator, dtype=np.float64)
+    result = np.zeros_like(numerator)
+    np.divide(numerator, denominator, out=result, where=denominator != 0)
+    return result
+
+
+class ConfusionMatrix:
+    'Accumulates an n_class x n_class confusion matrix and derives labeling metrics from it'
+
+    def __init__(self, n_class, matrix=None):
+        self.n_class = n_class
+        self.matrix = np.zeros((n_class, n_class), dtype=np.int64) if matrix is None else np.asarray(matrix, dtype=np.int64)
+
+    @classmethod
+    def from_labels(cls, labels_true, labels_pred, n_class):
+        confusion = cls(n_class)
+        confusion.update(labels_true, labels_pred)
+        return confusion
+
+    def update(self, labels_true, labels_pred):
+        labels_true = np.asarray(labels_true, dtype=np.int64).ravel()
+        labels_pred = np.asarray(labels_pred, dtype=np.int64).ravel()
+        assert labels_true.shape == labels_pred.shape
+        self.matrix += np.bincount(labels_true * self.n_class + labels_pred,
+                                   minlength=self.n_class * self.n_class).reshape(self.n_class, self.n_class)
+        return self
+
+    def merge(self, other):
+        assert self.n_class == other.n_class
+        return ConfusionMatrix(self.n_class, self.matrix + other.matrix)
+
+    def __add__(self, other):
+        return self.merge(other)
+
+    ##### per-class statistics ####
+    @property
+    def n_samples(self):
+        return int(self.matrix.sum())
+
+    @property
+    def true_positives(self):
+        return np.diag(self.matrix)
+
+    @property
+    def support(self):
+        return self.matrix.sum(axis=1)
+
+    @property
+    def predicted(self):
+        return self.matrix.sum(axis=0)
+
+    @property
+    def present_labels(self):
+        # labels seen in either the true or the predicted labels
+        return np.flatnonzero((self.support > 0) | (self.predicted > 0))
+
+    def precision_per_class(self):
+        return _divide(self.true_positives, self.predicted)
+
+    def recall_per_class(self):
+        return _divide(self.true_positives, self.support)
+
+    def f1_per_class(self):
+        return _divide(2 * self.true_positives, self.support + self.predicted)
+
+    ##### summary metrics ####
+    def accuracy(self):
+        return float(_divide(self.true_positives.sum(), self.n_samples))
+
+    def _average(self, per_class, average):
+        if average is None:
+            return per_class[self.present_labels]
+        if average == 'micro':
+            # every sample has exactly one true and one predicted label
+            return self.accuracy()
+        if average == 'macro':
+            return float(per_class[self.present_labels].mean())
+        if average == 'weighted':
+            support = self.support[self.present_labels]
+            return float(_divide((per_class[self.present_labels] * support).sum(), support.sum()))
+        raise ValueError("Unknown average: {}".format(average))
+
+    def precision(self, average='macro'):
+        return self._average(self.precision_per_class(), average)
+
+    def recall(self, average='macro'):
+        return self._average(self.recall_per_class(), average)
+
+    def f1(self, average='macro'):
+        return self._average(self.f1_per_class(), average)
+
+    def f1_median(self):
+        return float(np.median(self.f1(average=None)))
+
+    def adjusted_rand_score(self):
+        # pair confusion matrix computed from the contingency table, as in sklearn
+        n_samples = self.n_samples
+        sum_squares = int((self.matrix ** 2).sum())
+        n_true, n_pred = self.support, self.predicted
+        tp = sum_squares - n_samples
+        fp = int((self.matrix * n_pred[None, :]).sum()) - sum_squares
+        fn = int((self.matrix * n_true[:, None]).sum()) - sum_squares
+        tn = n_samples ** 2 - fp - fn - sum_squares
+        if fn == 0 and fp == 0:
+            return 1.0
+        return 2. * (tp * tn - fn * fp) / ((tp + fn) * (fn + tn) + (tp + fp) * (fp + tn))
+
+    def classification_report(self, target_names=None, digits=2):
+        # text layout of sklearn.metrics.classification_report over all classes
+        if target_names is None:
+            target_names = [str(i) for i in range(self.n_class)]
+        target_names = [str(name) for name in target_names]
+        n_names = len(target_names)
+        precision, recall, f1 = self.precision_per_class()[:n_names], self.recall_per_class()[:n_names], self.f1_per_class()[:n_names]
+        support = self.support[:n_names]
+
+        headers = ["precision", "recall", "f1-score", "support"]
+        width = max(max(len(name) for name in target_names), len("weighted avg"), digits)
+        head_fmt = "{:>{width}s} " + " {:>9}" * len(headers)
+        report = head_fmt.format("", *headers, width=width) + "\n\n"
+        row_fmt = "{:>{width}s} " + " {:>9.{digits}f}" * 3 + " {:>9}\n"
+        for i, name in enumerate(target_names):
+            report += row_fmt.format(name, precision[i], recall[i], f1[i], int(support[i]), width=width, digits=digits)
+        report += "\n"
+
+        total = int(support.sum())
+        row_fmt_accuracy = "{:>{width}s} " + " {:>9.{digits}}" * 2 + " {:>9.{digits}f}" + " {:>9}\n"
+        report += row_fmt_accuracy.format("accuracy", "", "", self.accuracy(), total, width=width, digits=digits)
+        report += row_fmt.format("macro avg", precision.mean(), recall.mean(), f1.mean(), total,
+                                 width=width, digits=digits)
+        weights = _divide(support, total)
+        report += row_fmt.format("weighted avg", (precision * weights).sum(), (recall * weights).sum(),
+                                 (f1 * weights).sum(), total, width=width, digits=digits)
+        return report
@@ -1,34 +1,25 @@
 import torch
-from torchvision import models
 from torch import nn
 import pytorch_lightning as pl
 from torch.optim import lr_scheduler
 from sklearn.model_selection import train_test_split
-from torch.utils.data import DataLoader, random_split, Subset, Dataset
-from torch.nn import functional as F
-from torchvision import datasets, transforms
-import torch.optim as optim
-import os
-from tqdm import tqdm
+from torch.utils.data import Subset
 from pytorch_lightning.callbacks import ModelCheckpoint
 from pytorch_lightning.callbacks.early_stopping import EarlyStopping
-from collections import Counter
-import statistics
-from torchvision.datasets.utils import download_and_extract_archive
-import pandas as pd
 import numpy as np
-from sklearn import preprocessing
-from sklearn.metrics import f1_score
 # from ray.tune.integration.pytorch_lightning import TuneReportCallback
 # from ray import tune
 # from ray.tune import CLIReporter
-import shutil
-import fairscale
 import argparse
 
 
 from util import *
 from dataModule import *
+from hashModel import build_hash_layer, hash_forward, encode_batches, quantize_hash_layer
+from timing import stage_timer, peak_rss_mb
+import os
+import time
+from bundle import export_bundle, write_label_mapping
 
 import torch.multiprocessing
 torch.multiprocessing.set_sharing_strategy('file_system')
@@ -77,11 +68,100 @@ def test_class_balance_loss():
 
     return
 
+###------------------------------Timing callback---------------------------------------###
+# Per-epoch throughput of the train, validation and test loops, logged through log_dict:
+# - <Phase>_cells_per_sec: cells / (loader stall + step time)
+# - <Phase>_loader_stall_sec: time spent waiting for the next batch from the DataLoader
+# - <Phase>_step_sec: time from receiving a batch to the end of its step
+# - <Phase>_metric_sec and per-stage timings recorded in util (encode, annotate, metrics, retrieval, map)
+# - Peak_RSS_MB: peak resident memory of the process
+# CUDA kernels run asynchronously, so on GPU the step time of one batch can show up as
+# stall time of the next; the epoch totals stay correct.
+
+class TimingCallback(pl.Callback):
+
+    METRIC_STAGES = ("annotate", "metrics", "retrieval")
+
+    def __init__(self):
+        super().__init__()
+        self.phases = {}
+
+    def _epoch_start(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = {"cells": 0, "stall": 0., "step": 0., "last_end": now, "batch_start": now}
+        if phase != "Train":
+            stage_timer.reset()
+
+    def _batch_start(self, phase):
+        state = self.phases[phase]
+        now = time.perf_counter()
+        state["stall"] += now - state["last_end"]
+        state["batch_start"] = now
+
+    def _batch_end(self, phase, batch):
+        state = self.phases[phase]
+        now = time.perf_counter()
+        state["step"] += now - state["batch_start"]
+        state["last_end"] = now
+        state["cells"] += len(batch[1])
+
+    def _epoch_end(self, trainer, pl_module, phase):
+        state = self.phases.pop(phase, None)
+        if state is None or trainer.sanity_checking:
+            return
+        busy = state["stall"] + state["step"]
+        value = {phase + "_cells_per_sec": state["cells"] / busy if busy > 0 else 0.,
+                 phase + "_loader_stall_sec": state["stall"],
+                 phase + "_step_sec": state["step"]}
+        if phase != "Train":
+            value[phase + "_metric_sec"] = stage_timer.total(self.METRIC_STAGES)
+            value.update(stage_timer.summary(prefix=phase + "_"))
+        rss = peak_rss_mb()
+        if rss is not None:
+            value["Peak_RSS_MB"] = rss
+        pl_module.log_dict(value, logger=True)
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self._epoch_start("Train")
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx, *args):
+        self._batch_start("Train")
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, *args):
+        self._batch_end("Train", batch)
+
+    def on_train_epoch_end(self, trainer, pl_module, *args):
+        self._epoch_end(trainer, pl_module, "Train")
+
+    def on_validation_epoch_start(self, trainer, pl_module):
+        self._epoch_start("Val")
+
+    def on_validation_batch_start(self, trainer, pl_module, batch, batch_idx, *args):
+        self._batch_start("Val")
+
+    def on_validation_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, *args):
+        self._batch_end("Val", batch)
+
+    def on_validation_epoch_end(self, trainer, pl_module):
+        self._epoch_end(trainer, pl_module, "Val")
+
+    def on_test_epoch_start(self, trainer, pl_module):
+        self._epoch_start("Test")
+
+    def on_test_batch_start(self, trainer, pl_module, batch, batch_idx, *args):
+        self._batch_start("Test")
+
+    def on_test_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, *args):
+        self._batch_end("Test", batch)
+
+    def on_test_epoch_end(self, trainer, pl_module):
+        self._epoch_end(trainer, pl_module, "Test")
+
 ###------------------------------Model---------------------------------------###
 
 
 class scDeepHashModel(pl.LightningModule):
-    def __init__(self, n_class, n_features, batch_size=64, l_r=1e-5, lamb_da=0.0001, beta=0.9999, bit=64, lr_decay=0.9, decay_every=20, n_layers=5, weight_decay=0.0005, measure_retrieval=False, topK=-1):
+    def __init__(self, n_class, n_features, batch_size=64, l_r=1e-5, lamb_da=0.0001, beta=0.9999, bit=64, lr_decay=0.9, decay_every=20, n_layers=5, weight_decay=0.0005, measure_retrieval=False, topK=-1, map_workers=1, train_metrics_fraction=0.1, encoding_cache_dir=None, anchor_seed=0):
         super(scDeepHashModel, self).__init__()
         print("hparam: l_r = {}, lambda = {}, beta = {}".format(l_r, lamb_da, beta))
         self.batch_size = batch_size
@@ -93,59 +173,37 @@ class scDeepHashModel(pl.LightningModule):
         self.lr_decay = lr_decay
         self.decay_every = decay_every
         self.samples_in_each_class = None  # Later initialized in training step
-        self.cell_anchors = get_cell_anchors(self.n_class, self.bit)
+        # the random anchor search is cached next to the encodings when a cache directory is given
+        anchor_cache_dir = os.path.join(encoding_cache_dir, 'anchors') if encoding_cache_dir else None
+        self.cell_anchors = get_cell_anchors(self.n_class, self.bit, seed=anchor_seed, cache_dir=anchor_cache_dir)
         self.n_layers = n_layers
         self.weight_decay = weight_decay
         self.measure_retrieval = measure_retrieval
         self.topK = topK
+        self.map_workers = map_workers
+        # fraction of the training set (stratified) re-encoded for train metrics at validation, 0 disables them
+        self.train_metrics_fraction = train_metrics_fraction
+        self._train_metrics_subset = None
+        # directory of cached retrieval database encodings, None disables the cache
+        self.encoding_cache_dir = encoding_cache_dir
         ##### model structure ####
-        if n_layers == 5:
-            self.hash_layer = nn.Sequential(
-                nn.Linear(n_features, 9000),
-                nn.ReLU(inplace=True),
-                nn.Dropout(0.2),
-                nn.Linear(9000, 3150),
-                nn.ReLU(inplace=True),
-                nn.Dropout(0.2),
-                nn.Linear(3150, 900),
-                nn.ReLU(inplace=True),
-                nn.Dropout(0.2),
-                nn.Linear(900, 450),
-                nn.ReLU(inplace=True),
-                nn.Linear(450, 200),
-                nn.ReLU(inplace=True),
-                nn.Linear(200, self.bit),
-            )
-        elif n_layers == 4:
-            self.hash_layer = nn.Sequential(
-                nn.Linear(n_features, 5000),
-                nn.ReLU(inplace=True),
-                nn.Dropout(0.2),
-                nn.Linear(5000, 2000),
-                nn.ReLU(inplace=True),
-                nn.Dropout(0.2),
-                nn.Linear(2000, 800),
-                nn.ReLU(inplace=True),
-                nn.Linear(800, 300),
-                nn.ReLU(inplace=True),
-                nn.Linear(300, self.bit),
-            )
-        elif n_layers == 3:
-            self.hash_layer = nn.Sequential(
-                nn.Linear(n_features, 4000),
-                nn.ReLU(inplace=True),
-                nn.Dropout(),
-                nn.Linear(4000, 1000),
-                nn.ReLU(inplace=True),
-                nn.Linear(1000, 250),
-                nn.ReLU(inplace=True),
-                nn.Linear(250, self.bit),
-            )
+        self.hash_layer = build_hash_layer(n_features, self.bit, n_layers)
 
     def forward(self, x):
         # forward pass returns prediction
-        x = self.hash_layer(x)
-        return x
+        return hash_forward(self.hash_layer, x)
+
+    def encode(self, data, batch_size=1024, device=None, num_threads=None):
+        # Inference API: yields tanh hash codes (on CPU) for consecutive chunks of data, see hashModel.encode_batches
+        return encode_batches(self, data, batch_size, device, num_threads)
+
+    def quantize(self):
+        ''' Convert the hash layer to dynamic int8 (per-channel weight scales) for CPU inference.
+        The model is moved to CPU; use compare_quantized_model to check agreement with the float model.
+        '''
+        self.cpu()
+        self.hash_layer = quantize_hash_layer(self.hash_layer)
+        return self
 
     def get_class_balance_loss_weight(samples_in_each_class, n_class, beta=0.9999):
         # Class-Balanced Loss on Effective Number of Samples
@@ -188,26 +246,47 @@ class scDeepHashModel(pl.LightningModule):
         data, labels = val_batch
         hash_codes = self.forward(data)
         loss = self.loss_functions(hash_codes, labels)
-        return loss
+        # keep the codes so validation metrics do not need another pass over the data
+        return {"loss": loss, "hash_codes": hash_codes.detach().tanh(), "labels": labels.detach()}
 
-    def validation_epoch_end(self, outputs):
+    def train_metrics_dataloader(self):
+        # stratified subsample of the training set used for train metrics, chosen once per training set
+        train_dataloader = self.trainer.datamodule.train_dataloader()
+        dataset = train_dataloader.dataset
+        if self.train_metrics_fraction >= 1:
+            return train_dataloader
+        if self._train_metrics_subset is None or self._train_metrics_subset[0] is not dataset:
+            labels = np.asarray(dataset.labels)
+            indices = np.arange(len(labels))
+            try:
+                indices, _ = train_test_split(indices, train_size=self.train_metrics_fraction,
+                                              stratify=labels, random_state=0)
+            except ValueError:
+                # too few cells in some class to stratify
+                indices, _ = train_test_split(indices, train_size=self.train_metrics_fraction, random_state=0)
+            subset = dataset.subset(indices) if hasattr(dataset, "subset") else Subset(dataset, indices)
+            self._train_metrics_subset = (dataset, subset)
+        return batch_dataloader(self._train_metrics_subset[1], batch_size=self.trainer.datamodule.batch_size)
 
-        val_loss_epoch = torch.stack([x for x in outputs]).mean()
+    def validation_epoch_end(self, outputs):
 
-        val_dataloader = self.trainer.datamodule.val_dataloader()
-        train_dataloader = self.trainer.datamodule.train_dataloader()
+        val_loss_epoch = torch.stack([x["loss"] for x in outputs]).mean()
+        val_binaries = torch.cat([x["hash_codes"] for x in outputs])
+        val_labels = torch.cat([x["labels"] for x in outputs])
 
-        val_matrics_CHC = compute_metrics(val_dataloader, self, self.n_class)
+        val_matrics_CHC = compute_metrics_from_codes(val_binaries.sign(), val_labels, self, self.n_class)
         (val_labeling_accuracy_CHC, 
         val_F1_score_weighted_average_CHC, val_F1_score_median_CHC, val_F1_score_per_class_CHC, val_F1_score_macro_CHC, val_F1_score_micro_CHC,
         val_precision, val_recall,
         ari, map_score, class_report) = val_matrics_CHC
 
-        train_matrics_CHC = compute_metrics(train_dataloader, self, self.n_class)
-        (_, 
-        _, train_F1_score_median_CHC, _, _, _,
-        _, _,
-        _, _, _) = train_matrics_CHC
+        train_F1_score_median_CHC = None
+        if self.train_metrics_fraction > 0:
+            train_matrics_CHC = compute_metrics(self.train_metrics_dataloader(), self, self.n_class)
+            (_, 
+            _, train_F1_score_median_CHC, _, _, _,
+            _, _,
+            _, _, _) = train_matrics_CHC
 
         if not self.trainer.sanity_checking:
             print(f"Epoch: {self.current_epoch}, Val_loss_epoch: {val_loss_epoch:.2f}")
@@ -220,7 +299,7 @@ class scDeepHashModel(pl.LightningModule):
                     val_precision:{val_precision:.3f}, \
                     val_recall:{val_recall:.3f}, \
                     val_ARI: {ari:.3f}, \
-                    train_F1_score_median_CHC: {train_F1_score_median_CHC:.3f}")
+                    train_F1_score_median_CHC: {'n/a' if train_F1_score_median_CHC is None else f'{train_F1_score_median_CHC:.3f}'}")
             print("map score =", map_score)
 
 
@@ -232,8 +311,9 @@ class scDeepHashModel(pl.LightningModule):
                   "Val_F1_score_micro_CHC:" : val_F1_score_micro_CHC,
                   "Val_precision:" : val_precision,
                   "Val_recall:" : val_recall,
-                  "Val_ARI:" : ari,
-                  "Train_F1_score_median_CHC:" : train_F1_score_median_CHC}
+                  "Val_ARI:" : ari}
+        if train_F1_score_median_CHC is not None:
+            value["Train_F1_score_median_CHC:"] = train_F1_score_median_CHC
                   
         self.log_dict(value, prog_bar=True, logger=True)
 
@@ -251,7 +331,7 @@ class scDeepHashModel(pl.LightningModule):
         train_dataloader = self.trainer.datamodule.train_dataloader()
         val_dataloader = self.trainer.datamodule.val_dataloader()
 
-        test_matrics_CHC = compute_metrics(test_dataloader, self, self.n_class, show_time=True, use_cpu=False, measure_retrieval=self.measure_retrieval, topK=self.topK)
+        test_matrics_CHC = compute_metrics(test_dataloader, self, self.n_class, show_time=True, use_cpu=False, measure_retrieval=self.measure_retrieval, topK=self.topK, map_workers=self.map_workers, encoding_cache_dir=self.encoding_cache_dir)
 
         (test_labeling_accuracy_CHC, 
         test_F1_score_weighted_average_CHC, test_F1_score_median_CHC, test_F1_score_per_class_CHC, test_F1_score_macro_CHC, test_F1_score_micro_CHC,
@@ -298,6 +378,15 @@ class scDeepHashModel(pl.LightningModule):
         return [optimizer], [exp_lr_scheduler]
 
 
+def export_model_bundle(model, datamodule, path, data_name, dtype='float16'):
+    # bundle for lightweight annotation (see bundle.py), plus the label mapping read by visualize.py
+    label_mapping = list(datamodule.label_mapping.classes_) if datamodule.label_mapping is not None else None
+    export_bundle(model, path, genes=getattr(datamodule, "gene_names", None), label_mapping=label_mapping,
+                  dtype=dtype, metadata={"dataset": data_name, "n_layers": model.n_layers})
+    if label_mapping is not None:
+        print("Saved label mapping to", write_label_mapping(label_mapping, data_name))
+
+
 if __name__ == '__main__':
     # Parse parameters
     parser = argparse.ArgumentParser()
@@ -332,6 +421,20 @@ if __name__ == '__main__':
                         help="Whether to measure retrieval metrics (MAP)")
     parser.add_argument("--topK", type=int, default=-1,
                         help="topK for MAP")
+    parser.add_argument("--map_workers", type=int, default=1,
+                        help="Number of threads used to compute MAP")
+    parser.add_argument("--train_metrics_fraction", type=float, default=0.1,
+                        help="Fraction of the training set encoded for train metrics at validation, 0 disables them")
+    parser.add_argument("--encoding_cache_dir", type=str, default='',
+                        help="Directory to cache retrieval database encodings per checkpoint and the random cell anchors, empty to disable")
+    parser.add_argument("--anchor_seed", type=int, default=0,
+                        help="Seed of the random cell anchors used when classes outnumber 2 * bit")
+    parser.add_argument("--quantize", type=bool, default=False,
+                        help="Report int8 dynamic quantization agreement with the float model on the validation split")
+    parser.add_argument("--export_bundle", type=str, default='',
+                        help="Directory to write a compact model bundle (weights, anchors, genes, label mapping) to after testing")
+    parser.add_argument("--bundle_dtype", choices=['float16', 'float32'], default='float16',
+                        help="Weight precision of the exported bundle")
     parser.add_argument("--feature_selection", type=bool, default=False,
                         help="Whether to use feature selection for input data")
     parser.add_argument("--checkpoint_path", type=str,
@@ -353,6 +456,13 @@ if __name__ == '__main__':
     test_checkpoint = args.test
     measure_retrieval = args.measure_retrieval
     topK = args.topK
+    map_workers = args.map_workers
+    train_metrics_fraction = args.train_metrics_fraction
+    encoding_cache_dir = args.encoding_cache_dir or None
+    anchor_seed = args.anchor_seed
+    quantize = args.quantize
+    bundle_path = args.export_bundle
+    bundle_dtype = args.bundle_dtype
     feature_selection = args.feature_selection
     checkpoint_path = args.checkpoint_path
 
@@ -416,13 +526,15 @@ if __name__ == '__main__':
                             progress_bar_refresh_rate=0,
                             # limit_train_batches=0.2,
                             # limit_val_batches=0.2,
-                            callbacks=[checkpoint_callback]
+                            callbacks=[checkpoint_callback, TimingCallback()]
                             )
         print(N_FEATURES)
         model = scDeepHashModel(N_CLASS, N_FEATURES, l_r=l_r, lamb_da=lamb_da,
                             beta=beta, lr_decay=lr_decay, decay_every=decay_every,
                             n_layers=n_layers, weight_decay=weight_decay,
-                            measure_retrieval=measure_retrieval, topK=topK)
+                            measure_retrieval=measure_retrieval, topK=topK, map_workers=map_workers,
+                            train_metrics_fraction=train_metrics_fraction, encoding_cache_dir=encoding_cache_dir,
+                            anchor_seed=anchor_seed)
 
         trainer.fit(model, datamodule)
         trainer.test(model)
@@ -434,17 +546,21 @@ if __name__ == '__main__':
         trainer = pl.Trainer(max_epochs=max_epochs,
                 gpus=1,
                 check_val_every_n_epoch=5,
-                callbacks=[checkpoint_callback]
+                callbacks=[checkpoint_callback, TimingCallback()]
                 )
         best_model = scDeepHashModel.load_from_checkpoint(
             best_model_path, n_class=N_CLASS, n_features=N_FEATURES,
             l_r=l_r, lamb_da=lamb_da,
             beta=beta, lr_decay=lr_decay, decay_every=decay_every,
-            n_layers=n_layers, weight_decay=weight_decay)
+            n_layers=n_layers, weight_decay=weight_decay, anchor_seed=anchor_seed)
             
         best_model.eval()
 
         trainer.test(best_model, datamodule=datamodule)
+        if quantize:
+            compare_quantized_model(best_model, datamodule.val_dataloader())
+        if bundle_path:
+            export_model_bundle(best_model, datamodule, bundle_path, dataset, bundle_dtype)
 
     # To test against a specific checkpoint
     else:
@@ -455,14 +571,19 @@ if __name__ == '__main__':
                                         mode='max')
         trainer = pl.Trainer(max_epochs=max_epochs,
                         gpus=1,
-                        callbacks=[checkpoint_callback]
+                        callbacks=[checkpoint_callback, TimingCallback()]
                         )
         model = scDeepHashModel.load_from_checkpoint(
             test_checkpoint, n_class=N_CLASS, n_features=N_FEATURES, l_r=l_r, lamb_da=lamb_da,
                             beta=beta, lr_decay=lr_decay, decay_every=decay_every,
                             n_layers=n_layers, weight_decay=weight_decay,
-                            measure_retrieval=measure_retrieval, topK=topK)
+                            measure_retrieval=measure_retrieval, topK=topK, map_workers=map_workers,
+                            encoding_cache_dir=encoding_cache_dir, anchor_seed=anchor_seed)
 
         model.eval()
 
         trainer.test(model, datamodule=datamodule)
+        if quantize:
+            compare_quantized_model(model, datamodule.val_dataloader())
+        if bundle_path:
+            export_model_bundle(model, datamodule, bundle_path, dataset, bundle_dtype)
@@ -0,0 +1,72 @@
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+###------------------------------Stage timers---------------------------------###
+# Wall-clock time and item counts accumulated per named stage. Each stage costs two
+# perf_counter calls and a dict update, so the timers stay on in production runs.
+# compute_metrics, compute_result and the MAP functions record into stage_timer;
+# TimingCallback (scDeepHash.py) resets it every epoch and logs what was recorded.
+
+
+class _StageRecord:
+    __slots__ = ('items',)
+
+    def __init__(self, items):
+        self.items = items
+
+
+class StageTimer:
+    'Accumulates seconds, items and calls per stage name'
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.seconds = defaultdict(float)
+        self.items = defaultdict(int)
+        self.calls = defaultdict(int)
+
+    @contextmanager
+    def stage(self, name, items=0):
+        ''' Time the body of a with block. The item count (e.g. cells) can be given
+        up front or set on the yielded record once it is known:
+            with stage_timer.stage("encode") as record:
+                ...
+                record.items = n_cells
+        '''
+        record = _StageRecord(items)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+            self.items[name] += record.items
+            self.calls[name] += 1
+
+    def total(self, names):
+        return sum(self.seconds.get(name, 0.) for name in names)
+
+    def summary(self, prefix=''):
+        # {<prefix><stage>_sec, <prefix><stage>_cells_per_sec} for every recorded stage
+        values = {}
+        for name, seconds in self.seconds.items():
+            values[prefix + name + "_sec"] = seconds
+            if self.items[name] and seconds > 0:
+                values[prefix + name + "_cells_per_sec"] = self.items[name] / seconds
+        return values
+
+
+stage_timer = StageTimer()
+
+
+def peak_rss_mb():
+    # peak resident set size of this process, None where the resource module is unavailable
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
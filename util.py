@@ -1,23 +1,22 @@
-# direct import  hadamrd matrix from scipy
-from scipy.linalg import hadamard  
 import torch
-from torchvision import models
-from torch import nn
-import pytorch_lightning as pl
-from torch.nn import functional as F
-from tqdm import tqdm
 from collections import Counter
-import statistics
-import pandas as pd
 import numpy as np
-from sklearn.metrics import f1_score, precision_score, recall_score
-from sklearn.metrics.cluster import adjusted_rand_score
-from sklearn.metrics import classification_report
 import time
+import os
+import hashlib
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+from hamming import pack_binaries, as_packed, calc_hamming_dist_packed, annotate_closest_cell_anchor, MultiIndexHashing, topk_blocks, topk_by_distance, rank_by_distance, query_block_size
+from hashDatabase import save_hash_database, open_hash_database
+from metrics import ConfusionMatrix
+from anchors import get_cell_anchors
+from hashModel import quantize_hash_layer, module_device
+from timing import stage_timer
 
 
 # top-level interface for metric calculation
-def compute_metrics(query_dataloader, net, class_num, show_time=False, use_cpu=False, measure_retrieval=False, topK=-1):
+def compute_metrics(query_dataloader, net, class_num, show_time=False, use_cpu=False, measure_retrieval=False, topK=-1, map_workers=1, encoding_cache_dir=None):
     ''' Labeling Strategy:
     Closest Cell Anchor:
     Label the query using the label associated to the nearest cell anchor
@@ -33,50 +32,64 @@ def compute_metrics(query_dataloader, net, class_num, show_time=False, use_cpu=F
     else:
         # print("Compute result using gpu")
         binaries_query, labels_query = compute_result(query_dataloader, net)
-    labels_pred_CHC = get_labels_pred_closest_cell_anchor(binaries_query.cpu().numpy(), labels_query.numpy(),
-                                                        net.cell_anchors.numpy())
-    CHC_duration = time.time() - start_time_CHC
+    # metrics are computed on sign-binarized codes
+    binaries_query = binaries_query.sign()
+    encode_duration = time.time() - start_time_CHC
+    return compute_metrics_from_codes(binaries_query, labels_query, net, class_num, show_time=show_time,
+                                      measure_retrieval=measure_retrieval, topK=topK, map_workers=map_workers,
+                                      encode_duration=encode_duration, encoding_cache_dir=encoding_cache_dir)
+
+
+# metric calculation on hash codes that are already computed, e.g. gathered in validation_step
+# binaries_query: sign-binarized (+1/-1) codes. Closest cell anchor labels and MAP use the
+# Hamming distance between these binary codes, not the L1 distance between tanh outputs
+def compute_metrics_from_codes(binaries_query, labels_query, net, class_num, show_time=False, measure_retrieval=False, topK=-1, map_workers=1, encode_duration=0, encoding_cache_dir=None):
+    binaries_query, labels_query = binaries_query.cpu(), labels_query.cpu()
     query_num = binaries_query.shape[0]
+    start_time_CHC = time.time()
+    with stage_timer.stage("annotate", items=query_num):
+        labels_pred_CHC, _, _ = annotate_closest_cell_anchor(binaries_query.numpy(), net.cell_anchors.numpy())
+    CHC_duration = encode_duration + time.time() - start_time_CHC
     if show_time:
         print("\n")
         print("  - Time spent on annotating {} test data: {:.2f}s".format(query_num, CHC_duration))
         print("  - CHC query speed: {:.2f} queries/s".format(query_num/CHC_duration))
     
-    # (1) labeling accuracy
-    labeling_accuracy_CHC = compute_labeling_strategy_accuracy(labels_pred_CHC, labels_query.numpy())
+    with stage_timer.stage("metrics", items=query_num):
+        # all labeling metrics below come from one confusion matrix
+        target_names = [i for i in net.trainer.datamodule.label_mapping.classes_]
+        n_labels = max(len(target_names), net.cell_anchors.shape[0], int(labels_query.max()) + 1 if query_num else 0)
+        confusion = ConfusionMatrix.from_labels(labels_query.numpy(), labels_pred_CHC, n_labels)
+
+        # (1) labeling accuracy
+        labeling_accuracy_CHC = confusion.accuracy()
     
-    # (2) F1_score, average = (micro, macro, weighted)
-    F1_score_weighted_average_CHC = f1_score(labels_query, labels_pred_CHC, average='weighted')
-    F1_score_macro_CHC = f1_score(labels_query, labels_pred_CHC, average='macro')
-    F1_score_micro_CHC = f1_score(labels_query, labels_pred_CHC, average='micro')
-    F1_score_per_class_CHC = f1_score(labels_query, labels_pred_CHC, average=None)
-    target_names = [i for i in net.trainer.datamodule.label_mapping.classes_]
-    class_report = classification_report(labels_query, labels_pred_CHC, labels=[i for i in range(len(target_names))], target_names=target_names)
+        # (2) F1_score, average = (micro, macro, weighted)
+        F1_score_weighted_average_CHC = confusion.f1(average='weighted')
+        F1_score_macro_CHC = confusion.f1(average='macro')
+        F1_score_micro_CHC = confusion.f1(average='micro')
+        F1_score_per_class_CHC = confusion.f1(average=None)
+        class_report = confusion.classification_report(target_names)
 
-    # (3) F1_score median
-    F1_score_median_CHC = statistics.median(F1_score_per_class_CHC)
+        # (3) F1_score median
+        F1_score_median_CHC = confusion.f1_median()
 
-    # (4) precision, recall
-    precision = precision_score(labels_query, labels_pred_CHC, average="macro")
-    recall = recall_score(labels_query, labels_pred_CHC, average="macro")
+        # (4) precision, recall
+        precision = confusion.precision(average="macro")
+        recall = confusion.recall(average="macro")
 
-    # (5) adjusted random index 
-    ari = adjusted_rand_score(labels_query, labels_pred_CHC)
+        # (5) adjusted random index 
+        ari = confusion.adjusted_rand_score()
 
     if measure_retrieval:
-        binaries_train, labels_train = compute_result(net.trainer.datamodule.train_dataloader(), net)
-        binaries_val, labels_val = compute_result(net.trainer.datamodule.val_dataloader(), net)
-        binaries_database, labels_database = torch.cat([binaries_train, binaries_val]), torch.cat([labels_train, labels_val])
+        with stage_timer.stage("retrieval", items=query_num):
+            binaries_database, labels_database = compute_database_result(net, encoding_cache_dir)
 
-        # one-hot encoding
-        labels_database_one_hot = categorical_to_onehot(labels_database, class_num)
-        labels_query_one_hot = categorical_to_onehot(labels_query, class_num)
-
-        # (6) MAP
-        map_score = compute_MAP(binaries_database.cpu().numpy(), binaries_query.cpu().numpy(), 
-                    labels_database_one_hot.numpy(), labels_query_one_hot.numpy(), topK)
-        save_retreival_result(binaries_database.cpu().numpy(), binaries_query.cpu().numpy(), 
-                    labels_database.numpy(), labels_query.numpy(), topK)
+            # (6) MAP
+            map_score = compute_MAP_batched(binaries_database, binaries_query.numpy(), 
+                        labels_database, labels_query.numpy(), topK, num_workers=map_workers)
+            save_retreival_result(binaries_database, binaries_query.numpy(), 
+                        labels_database, labels_query.numpy(), topK)
 
 
         # compute_retrieval_speed(binaries_database, binaries_query, 1000)
@@ -94,38 +107,6 @@ def compute_metrics(query_dataloader, net, class_num, show_time=False, use_cpu=F
 
     return CHC_metrics
 
-# generate cell anchors
-def get_cell_anchors(n_class, bit):
-    H_K = hadamard(bit)
-    H_2K = np.concatenate((H_K, -H_K), 0)
-    hash_targets = torch.from_numpy(H_2K[:n_class]).float()
-
-    if H_2K.shape[0] < n_class:
-        hash_targets.resize_(n_class, bit)
-        for k in range(20):
-            for index in range(H_2K.shape[0], n_class):
-                ones = torch.ones(bit)
-                # Bernouli distribution
-                sa = random.sample(list(range(bit)), bit // 2)
-                ones[sa] = -1
-                hash_targets[index] = ones
-            # to find average/min  pairwise distance
-            c = []
-            for i in range(n_class):
-                for j in range(n_class):
-                    if i < j:
-                        TF = sum(hash_targets[i] != hash_targets[j])
-                        c.append(TF)
-            c = np.array(c)
-
-            # choose min(c) in the range of K/4 to K/3
-            # see in https://github.com/yuanli2333/Hadamard-Matrix-for-hashing/issues/1
-            # but it is hard when bit is  small
-            if c.min() > bit / 4 and c.mean() >= bit / 2:
-                print(c.min(), c.mean())
-                break
-    return hash_targets
-
 def test_speed(dataloaders, net, size=280):
     # get data samples and evaluate them
     # Concatenate all data smaples from dataloader list
@@ -153,8 +134,8 @@ def test_speed(dataloaders, net, size=280):
     rep_num = 6
     for i in range(rep_num):
         start_time_CHC = time.time()
-        binary_codes = (net(data.cuda())).data
-        labels_pred_CHC = get_labels_pred_closest_cell_anchor(binary_codes.cpu().numpy(), labels.numpy(), net.cell_anchors.numpy())
+        binary_codes = torch.cat(list(net.encode(data))).sign()
+        labels_pred_CHC, _, _ = annotate_closest_cell_anchor(binary_codes.cpu().numpy(), net.cell_anchors.numpy())
         CHC_duration = time.time() - start_time_CHC
         times.append(CHC_duration)
     times = np.array(times)
@@ -162,7 +143,7 @@ def test_speed(dataloaders, net, size=280):
     print("  - Average CHC Query Speed with {} test data: {:.2f} queries/s, time = {:.2f}".format(query_num, query_num/times.mean(), times.mean()))
     print("  - Each time =", times)
 
-def compute_retrieval_speed(_binaries_database, _binaries_query, size):
+def compute_retrieval_speed(_binaries_database, _binaries_query, size, knn=None):
     print("-------Start computing retrieval speed---------")
     binaries_database, binaries_query = _binaries_database.cpu(), _binaries_query.cpu()
     binaries_database_oversample = binaries_database
@@ -173,129 +154,298 @@ def compute_retrieval_speed(_binaries_database, _binaries_query, size):
         binaries_database_oversample = torch.cat((binaries_database_oversample, binaries_database))[:size]
     print("oversampled database size =", binaries_database_oversample.shape[0])
 
-    binaries_query_np = binaries_query.numpy()
-    binaries_database_oversample_np = binaries_database_oversample.numpy()
+    binaries_query_packed = pack_binaries(binaries_query.numpy())
+    binaries_database_oversample_packed = pack_binaries(binaries_database_oversample.numpy())
 
     start_time = time.time()
     for iter in range(binaries_query.shape[0]):
-        hamm_dists = CalcHammingDist(binaries_query_np[iter, :], binaries_database_oversample_np)
-        hamm_indexes = np.argsort(hamm_dists)
+        hamm_dists = calc_hamming_dist_packed(binaries_query_packed[iter], binaries_database_oversample_packed)
+        hamm_indexes = rank_by_distance(hamm_dists, binaries_database.shape[1])
     duration = time.time() - start_time
     print("Duration =", duration, "s")
     print("Time per query cell =", duration/binaries_query.shape[0] * 1000, "ms")
 
-def save_retreival_result(retrieval_binaries, query_binaries, labels_database, labels_query, topk):
-    num_query = labels_query.shape[0]
-    labels_database_ranked_all = []
-    for iter in range(num_query):
-        hamm_dists = CalcHammingDist(query_binaries[iter, :], retrieval_binaries)
-        hamm_indexes = np.argsort(hamm_dists)
-        labels_database_ranked = labels_database[hamm_indexes]
-        labels_database_ranked = labels_database_ranked[0:topk]
-        labels_database_ranked_all.append(labels_database_ranked)
-
-    labels_database_ranked_all = np.stack(labels_database_ranked_all)
-    result_path = 'retrival_result.csv'
-    label_path ='qurty_label.csv'
-    pd.DataFrame(labels_database_ranked_all).to_csv(result_path)
-    pd.DataFrame(labels_query).to_csv(label_path)
-    return labels_database_ranked_all, labels_query
+    # exact kNN through the multi-index hashing tables
+    if knn is not None:
+        index = MultiIndexHashing(binaries_database_oversample_packed, binaries_database.shape[1])
+        start_time = time.time()
+        for iter in range(binaries_query.shape[0]):
+            knn_indexes, knn_dists = index.knn(binaries_query_packed[iter], knn)
+        duration = time.time() - start_time
+        print("Multi-index hashing {}-NN duration =".format(knn), duration, "s")
+        print("Time per query cell =", duration/binaries_query.shape[0] * 1000, "ms")
+
+# Top-K retrieval export
+# Neighbours exported per query when no topk is given (topk < 0): a full Q x N ranking
+# takes many GB for atlas-sized splits
+EXPORT_TOPK = 100
+
+
+def smallest_int_dtype(values):
+    # smallest integer dtype holding every value, other dtypes (e.g. string labels) are kept
+    values = np.asarray(values)
+    if values.dtype.kind not in 'iu' or values.size == 0:
+        return values.dtype
+    return np.result_type(np.min_scalar_type(values.min()), np.min_scalar_type(values.max()))
+
+
+# For every query the topk nearest database entries (topk < 0: EXPORT_TOPK of them) are written,
+# one block of queries at a time, to .npy files in output_dir:
+#   indices.npy        (Q, k) database indices sorted by distance, ties by database index
+#   distances.npy      (Q, k) Hamming distances
+#   labels.npy         (Q, k) database labels of the neighbours
+#   query_labels.npy   (Q,) query labels
+# Labels are stored in the smallest integer dtype that fits. Blocks of queries are sized
+# from the database size (see hamming.query_block_size) unless block_size is given.
+# Returns read-only memory maps of (indices, distances).
+def save_retreival_result(retrieval_binaries, query_binaries, labels_database, labels_query, topk, output_dir='retrieval_result', block_size=None):
+    retrieval_packed, query_packed = as_packed(retrieval_binaries), as_packed(query_binaries)
+    labels_database, labels_query = np.asarray(labels_database).ravel(), np.asarray(labels_query).ravel()
+    num_query, num_database = query_packed.shape[0], retrieval_packed.shape[0]
+    k = min(EXPORT_TOPK if topk < 0 else topk, num_database)
+    bit = retrieval_packed.shape[1] * 64
+
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {name: os.path.join(output_dir, name + '.npy') for name in ('indices', 'distances', 'labels', 'query_labels')}
+    index_dtype = np.int32 if num_database < 2**31 else np.int64
+    dist_dtype = np.uint8 if bit < 256 else np.uint16
+    indices = np.lib.format.open_memmap(paths['indices'], mode='w+', dtype=index_dtype, shape=(num_query, k))
+    distances = np.lib.format.open_memmap(paths['distances'], mode='w+', dtype=dist_dtype, shape=(num_query, k))
+    label_dtype = np.result_type(smallest_int_dtype(labels_database), smallest_int_dtype(labels_query))
+    labels = np.lib.format.open_memmap(paths['labels'], mode='w+', dtype=label_dtype, shape=(num_query, k))
+    with stage_timer.stage("export", items=num_query):
+        for start, block_indices, block_dists in topk_blocks(query_packed, retrieval_packed, k, block_size):
+            end = start + block_indices.shape[0]
+            indices[start:end] = block_indices
+            distances[start:end] = block_dists
+            labels[start:end] = labels_database[block_indices]
+    for array in (indices, distances, labels):
+        array.flush()
+    del indices, distances, labels
+    np.save(paths['query_labels'], labels_query.astype(label_dtype, copy=False))
+    return np.load(paths['indices'], mmap_mode='r'), np.load(paths['distances'], mmap_mode='r')
 
 # understanding Top K：https://towardsdatascience.com/breaking-down-mean-average-precision-map-ae462f623a52
 def compute_MAP(retrieval_binaries, query_binaries, retrieval_labels, query_labels, topk):
     num_query = query_labels.shape[0]
-    topK_ave_precision_per_query = 0
-    for iter in range(num_query):
-        # Given a query label，find the entries with the same labels Ex: [1,0,0,0,1,1,1,1,0,0]
-        ground_truths = (np.dot(query_labels[iter,:], retrieval_labels.transpose()) > 0).astype(np.float32)
-
-        # Given a query binary，calculate the hamming distances to all entries in database Ex: [2,10,14,9,1,2,1,2,1,4,6]
-        hamm_dists = CalcHammingDist(query_binaries[iter, :], retrieval_binaries)
+    retrieval_packed, query_packed = pack_binaries(retrieval_binaries), pack_binaries(query_binaries)
+    # only the first topk entries of the ranking are used
+    k = len(range(retrieval_packed.shape[0])[0:topk])
+    with stage_timer.stage("map", items=num_query):
+        topK_ave_precision_per_query = 0
+        for iter in range(num_query):
+            # Given a query label，find the entries with the same labels Ex: [1,0,0,0,1,1,1,1,0,0]
+            ground_truths = (np.dot(query_labels[iter,:], retrieval_labels.transpose()) > 0).astype(np.float32)
+
+            # Given a query binary，calculate the hamming distances to all entries in database Ex: [2,10,14,9,1,2,1,2,1,4,6]
+            hamm_dists = calc_hamming_dist_packed(query_packed[iter], retrieval_packed)
         
-        # sort hamming distance，return indexs
-        hamm_indexes = np.argsort(hamm_dists)
-
-        # ideal case: [1,1,1,1,1,0,0,0,0,0]
-        # hamming distance: [1,1,1,2,2,4,6,9,10,14]
-        ground_truths = ground_truths[hamm_indexes]
+            # sort hamming distance, return the first topk indexs (ties keep database order), counting over [0, bit]
+            hamm_indexes = topk_by_distance(hamm_dists, k, retrieval_binaries.shape[1])[0][0]
 
-        topK_ground_truths = ground_truths[0:topk]
+            # ideal case: [1,1,1,1,1,0,0,0,0,0]
+            # hamming distance: [1,1,1,2,2,4,6,9,10,14]
+            # the ranking already stops after the first topk entries
+            topK_ground_truths = ground_truths[hamm_indexes]
 
-        # Ex: topK_ground_truths = 5
-        topK_ground_truths_sum = np.sum(topK_ground_truths).astype(int)
+            # Ex: topK_ground_truths = 5
+            topK_ground_truths_sum = np.sum(topK_ground_truths).astype(int)
 
-        if topK_ground_truths_sum == 0:
-            continue
+            if topK_ground_truths_sum == 0:
+                continue
 
-        # Ex: [1,2,3,4,5]
-        matching_binaries = np.linspace(1, topK_ground_truths_sum, topK_ground_truths_sum)
+            # Ex: [1,2,3,4,5]
+            matching_binaries = np.linspace(1, topK_ground_truths_sum, topK_ground_truths_sum)
 
-        # ground truths position in 1 ~ n
-        ground_truths_pos = np.asarray(np.where(topK_ground_truths == 1)) + 1.0
+            # ground truths position in 1 ~ n
+            ground_truths_pos = np.asarray(np.where(topK_ground_truths == 1)) + 1.0
 
-        topK_ave_precision_per_query_ = np.mean(matching_binaries / (ground_truths_pos))
+            topK_ave_precision_per_query_ = np.mean(matching_binaries / (ground_truths_pos))
 
-        topK_ave_precision_per_query += topK_ave_precision_per_query_
+            topK_ave_precision_per_query += topK_ave_precision_per_query_
         
     topK_map = topK_ave_precision_per_query / num_query
 
     return topK_map
 
 
+# Block-wise MAP engine, gives the same result as compute_MAP
+# - labels are integer class ids instead of one-hot vectors
+# - when topk cuts the ranking, only the topk closest entries are selected and sorted
+# - query blocks can be spread over several threads (NumPy releases the GIL); every worker
+#   holds one block, so blocks are sized from N and num_workers under one memory budget
+def compute_MAP_batched(retrieval_binaries, query_binaries, retrieval_labels, query_labels, topk, block_size=None, num_workers=1):
+    retrieval_packed, query_packed = as_packed(retrieval_binaries), as_packed(query_binaries)
+    retrieval_labels, query_labels = np.asarray(retrieval_labels).ravel(), np.asarray(query_labels).ravel()
+    num_query, num_database = query_labels.shape[0], retrieval_labels.shape[0]
+    # same cut-off as ground_truths[0:topk] in compute_MAP
+    k = len(range(num_database)[0:topk])
+    if num_query == 0 or k == 0:
+        return 0.0
+    positions = np.arange(1, k + 1, dtype=np.float64)
+    if block_size is None:
+        # labels, matches, cumulative sums and precisions of the k ranked entries: ~40 bytes each
+        block_size = query_block_size(num_database, bytes_per_query=40 * k, num_workers=num_workers,
+                                      max_dist=64 * retrieval_packed.shape[1])
+        block_size = min(block_size, -(-num_query // num_workers))
+
+    def block_ave_precision(start):
+        hamm_dists = calc_hamming_dist_packed(query_packed[start:start + block_size], retrieval_packed)
+        # k closest entries, ties broken by database index as in a stable full sort
+        hamm_indexes, _ = topk_by_distance(hamm_dists, k, 64 * retrieval_packed.shape[1])
+        ground_truths = retrieval_labels[hamm_indexes] == query_labels[start:start + block_size, None]
+        ground_truths_sum = ground_truths.sum(axis=1)
+        precisions = np.cumsum(ground_truths, axis=1) / positions
+        precision_sum = np.where(ground_truths, precisions, 0).sum(axis=1)
+        valid = ground_truths_sum > 0
+        return np.sum(precision_sum[valid] / ground_truths_sum[valid])
+
+    starts = range(0, num_query, block_size)
+    with stage_timer.stage("map", items=num_query):
+        if num_workers > 1:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                block_sums = list(executor.map(block_ave_precision, starts))
+        else:
+            block_sums = [block_ave_precision(start) for start in starts]
+
+    return sum(block_sums) / num_query
+
+
 # Predict label using Closest Cell Anchor strategy (b)
 def get_labels_pred_closest_cell_anchor(query_binaries, query_labels, cell_anchors):
-    num_query = query_labels.shape[0]
-    labels_pred = []
-    for binary_query, label_query in zip(query_binaries, query_labels):
-          dists = CalcHammingDist(binary_query, cell_anchors)
-          closest_class = np.argmin(dists)
-        #   m = np.min(dists)
-        #   count = np.count_nonzero(dists==m)
-        #   print("Min dist =", m, "Count =", count)
-          labels_pred.append(closest_class)
+    labels_pred, _, _ = annotate_closest_cell_anchor(query_binaries, cell_anchors)
     return labels_pred
 
 
 # simply get the accuracy
 def compute_labeling_strategy_accuracy(labels_pred, labels_query):
-    same = 0
-
-    for i in range(len(labels_pred)):
-      if (labels_pred[i] == labels_query[i]).all():
-        same += 1
-
+    same = np.count_nonzero(np.asarray(labels_pred).ravel() == np.asarray(labels_query).ravel())
     return same / labels_query.shape[0]
 
 
 # compute Binary and get labels
-def compute_result(dataloader, net):
+def compute_result(dataloader, net, device=None, num_threads=None):
     binariy_codes, labels = [], []
-    net.eval()
-    for img, label in dataloader:
-        labels.append(label)
-        binariy_codes.append((net(img.cuda())).data)
-    return torch.cat(binariy_codes).tanh(), torch.cat(labels)
+
+    def batches():
+        for img, label in dataloader:
+            labels.append(label.cpu())
+            yield img
+
+    with stage_timer.stage("encode") as record:
+        for codes in net.encode(batches(), device=device, num_threads=num_threads):
+            binariy_codes.append(codes)
+            record.items += codes.shape[0]
+    return torch.cat(binariy_codes), torch.cat(labels)
 
 # compute Binary and get labels
 def compute_result_cpu(dataloader, net):
-    binariy_codes, labels = [], []
-    net.cpu()
-    net.eval()
-    for img, label in dataloader:
-        labels.append(label.cpu())
-        binariy_codes.append((net(img.cpu())).data)
-    return torch.cat(binariy_codes).tanh(), torch.cat(labels)
+    return compute_result(dataloader, net, device='cpu')
 
 
-# calcuate hamming distance，B1 is a vector，B2 is a matrix
-def CalcHammingDist(B1, B2):
-    # q = B2.shape[1]
-    # distH = 0.5 * (q - np.dot(B1, B2.transpose()))
-    # return distH
-    B1 = np.tile(B1, (B2.shape[0], 1))
-    distH = np.abs(B1 - B2)
-    distH = distH.sum(axis=1)
-    return distH
+# Comparison of the float and int8 hash layers, see hashModel.quantize_hash_layer
+
+def serialized_size(module):
+    # size in bytes of the saved state_dict
+    buffer = io.BytesIO()
+    torch.save(module.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+def compare_quantized_model(net, dataloader, num_threads=None):
+    ''' Encode the dataloader with the float and the int8 hash layer on CPU and report
+    - label_agreement: fraction of cells annotated with the same cell anchor
+    - bit_agreement: fraction of hash code bits with the same sign
+    - float_size / int8_size: serialized hash layer sizes in bytes
+    - float_speed / int8_speed: CPU encoding throughput in cells/s
+    '''
+    original_device = module_device(net)
+    float_layer = net.hash_layer
+    net.cpu()
+    cell_anchors = net.cell_anchors.numpy()
+    results = {}
+    try:
+        for name, hash_layer in (("float", float_layer), ("int8", quantize_hash_layer(float_layer))):
+            net.hash_layer = hash_layer
+            start_time = time.time()
+            codes, _ = compute_result(dataloader, net, device='cpu', num_threads=num_threads)
+            duration = time.time() - start_time
+            codes = codes.sign()
+            labels_pred, _, _ = annotate_closest_cell_anchor(codes.numpy(), cell_anchors)
+            results[name] = (codes.numpy() > 0, labels_pred)
+            results[name + "_size"] = serialized_size(hash_layer)
+            results[name + "_speed"] = codes.shape[0] / duration
+    finally:
+        net.hash_layer = float_layer
+        net.to(original_device)
+
+    (float_bits, float_labels), (int8_bits, int8_labels) = results.pop("float"), results.pop("int8")
+    results["label_agreement"] = float((float_labels == int8_labels).mean())
+    results["bit_agreement"] = float((float_bits == int8_bits).mean())
+    print("-------Int8 dynamic quantization---------")
+    print("  - Label agreement with float model: {:.4f}".format(results["label_agreement"]))
+    print("  - Sign bit agreement with float model: {:.4f}".format(results["bit_agreement"]))
+    print("  - Hash layer size: {:.1f} MB -> {:.1f} MB".format(results["float_size"] / 2**20, results["int8_size"] / 2**20))
+    print("  - CPU encoding speed: {:.0f} cells/s -> {:.0f} cells/s".format(results["float_speed"], results["int8_speed"]))
+    return results
+
+
+# fingerprint of the model weights, used to key cached encodings
+def model_fingerprint(net):
+    sha = hashlib.sha1(str(net.bit).encode())
+    for name, tensor in sorted(net.state_dict().items()):
+        sha.update(name.encode())
+        sha.update(tensor.detach().cpu().numpy().tobytes())
+    return sha.hexdigest()[:16]
+
+# fingerprint of the cells of a split: content of the expression file (datamodule.data_path)
+# and the row indices and labels of the split, so partitions of different runs never mix
+def split_fingerprint(datamodule, dataset):
+    from dataCache import file_content_hash
+    sha = hashlib.sha1()
+    data_path = getattr(datamodule, 'data_path', None)
+    if data_path is not None and os.path.exists(data_path):
+        sha.update(file_content_hash(data_path).encode())
+    for name in ('indices', 'labels'):
+        values = getattr(dataset, name, None)
+        if values is not None:
+            sha.update(name.encode())
+            sha.update(np.ascontiguousarray(values, dtype=np.int64).tobytes())
+    return sha.hexdigest()[:8]
+
+# compute packed binaries and labels of one datamodule split, reusing codes cached on disk
+# for the same model weights, dataset, fold and split (data content, rows and labels)
+def compute_result_cached(net, split, encoding_cache_dir=None, fingerprint=None):
+    datamodule = net.trainer.datamodule
+    dataloader = getattr(datamodule, split + '_dataloader')()
+    if encoding_cache_dir is None:
+        binaries, labels = compute_result(dataloader, net)
+        return pack_binaries(binaries.sign().cpu().numpy()), labels.numpy()
+
+    if fingerprint is None:
+        fingerprint = model_fingerprint(net)
+    name = "{}-fold{}-{}-{}-{}.shdb".format(datamodule.data_name, getattr(datamodule, 'fold_num', 0), split,
+                                            split_fingerprint(datamodule, dataloader.dataset), fingerprint)
+    path = os.path.join(encoding_cache_dir, name)
+    if os.path.exists(path):
+        print("Using cached {} encodings from {}".format(split, path))
+        database = open_hash_database(path)
+        return database.codes, database.labels
+
+    binaries, labels = compute_result(dataloader, net)
+    packed, labels = pack_binaries(binaries.sign().cpu().numpy()), labels.numpy()
+    os.makedirs(encoding_cache_dir, exist_ok=True)
+    tmp_path = path + '.tmp{}'.format(os.getpid())
+    save_hash_database(tmp_path, packed, net.bit, labels=labels,
+                       metadata={'dataset': datamodule.data_name, 'split': split, 'fingerprint': fingerprint})
+    os.replace(tmp_path, path)
+    return packed, labels
+
+# retrieval database (train + val) as packed binaries and labels
+def compute_database_result(net, encoding_cache_dir=None):
+    fingerprint = None if encoding_cache_dir is None else model_fingerprint(net)
+    binaries_train, labels_train = compute_result_cached(net, 'train', encoding_cache_dir, fingerprint)
+    binaries_val, labels_val = compute_result_cached(net, 'val', encoding_cache_dir, fingerprint)
+    return np.concatenate([binaries_train, binaries_val]), np.concatenate([labels_train, labels_val])
 
 
 def find_most_common_label(labels):
@@ -348,6 +498,7 @@ def t_sne_visualization_2d(data, labels):
 def calculate_gene_grad(model):
     print("---Get gene grad---")
     model.cuda()
+    anchors_packed = pack_binaries(model.cell_anchors.cpu().numpy())
     gradient_genes_per_cell_type = []
     
     # Calculate gradient for each cell type
@@ -360,14 +511,10 @@ def calculate_gene_grad(model):
             hash_codes = (model(img.cuda())).tanh()
             hash_codes_clone = torch.clone(hash_codes)
             hash_codes_clone = hash_codes_clone.cpu().detach().numpy()
-            predicted_labels = []
 
             # Find hit cell labels
-            for binary_query in hash_codes_clone:
-                dists = CalcHammingDist(binary_query, model.cell_anchors.cpu().numpy())
-                closest_class = np.argmin(dists)
-                predicted_labels.append(closest_class)
-            predicted_labels = torch.tensor(predicted_labels)
+            dists = calc_hamming_dist_packed(pack_binaries(hash_codes_clone), anchors_packed)
+            predicted_labels = torch.from_numpy(np.argmin(dists, axis=1))
             hit_index = (predicted_labels == label) * (query_label == label)
             # print("true_positives = ", hit_index)
 
@@ -388,27 +535,21 @@ def calculate_gene_grad(model):
     print("shape = ", gradient_genes_per_cell_type.shape)
 
 
-def output_result(model):
+def output_result(model, output_dir='.', encoding_cache_dir=None):
     print("Out put result for TM")
     model.cuda()
-    binaries_train, labels_train = compute_result(model.trainer.datamodule.train_dataloader(), model)
-    binaries_val, labels_val = compute_result(model.trainer.datamodule.val_dataloader(), model)
-    binaries_database, labels_database = torch.cat([binaries_train, binaries_val]), torch.cat([labels_train, labels_val])
-
-    binaries_test, labels_test = compute_result(model.trainer.datamodule.test_dataloader(), model)
-
-    binaries_database, labels_database = binaries_database.cpu(), labels_database.cpu()
-    binaries_test, labels_test = binaries_test.cpu(), labels_test.cpu()
+    binaries_database, labels_database = compute_database_result(model, encoding_cache_dir)
+    binaries_test, labels_test = compute_result_cached(model, 'test', encoding_cache_dir)
 
     print("binaries_database size =", binaries_database.shape)
     print("binaries_test size =", binaries_test.shape)
 
-    binaries_database = pd.DataFrame(binaries_database.numpy())
-    labels_train = pd.DataFrame(labels_train.numpy())
-    binaries_test = pd.DataFrame(binaries_test.numpy())
-    labels_test = pd.DataFrame(labels_test.numpy())
-
-    binaries_database.to_csv('temp1.csv')
-    labels_train.to_csv('temp2.csv')
-    binaries_test.to_csv('temp3.csv')
-    labels_test.to_csv('temp4.csv')
+    cell_anchors = model.cell_anchors.cpu().numpy()
+    label_mapping = list(model.trainer.datamodule.label_mapping.classes_)
+    database_path = os.path.join(output_dir, 'database.shdb')
+    query_path = os.path.join(output_dir, 'query.shdb')
+    save_hash_database(database_path, binaries_database, model.bit,
+                       labels=labels_database, cell_anchors=cell_anchors, label_mapping=label_mapping)
+    save_hash_database(query_path, binaries_test, model.bit,
+                       labels=labels_test, cell_anchors=cell_anchors, label_mapping=label_mapping)
+    print("Saved database to", database_path, "and queries to", query_path)
@@ -12,8 +12,8 @@ from sklearn.decomposition import PCA
 import seaborn as sns
 #from umap import UMAP
 from matplotlib import pyplot as plt
-from scDeepHash import scDeepHashModel
-from util import get_labels_pred_closest_cell_anchor
+from hashModel import load_encoder
+from hamming import annotate_closest_cell_anchor
 
 sns.set(rc={'figure.figsize':(11.7,8.27)})
 palette = sns.color_palette("pastel")
@@ -30,8 +30,7 @@ N_FEATURES = 17499
 with open(os.path.join("label_maps", data_name, "label_mapping.json")) as f:
             label_mapping = json.load(f)
 
-model = scDeepHashModel.load_from_checkpoint(checkpoint_path=CHECKPT_PATH,                                                        n_class=N_CLASS,
-                                           n_features=N_FEATURES)
+model = load_encoder(CHECKPT_PATH, n_class=N_CLASS, n_features=N_FEATURES)
 
 if not os.path.exists(data_dir+ '/' + data_name):
     url = "https://github.com/Aprilhuu/Deep-Learning-in-Single-Cell-Analysis/raw/main/BaronHuman.zip"
@@ -49,15 +48,14 @@ data = pd.read_csv(DataPath, index_col=0, sep=',')
 print("Data loaded!")
 
 
-input_data = torch.from_numpy(data.values).float()
-binary_predict = model.forward(input_data).sign()
-labels_pred_CHC = get_labels_pred_closest_cell_anchor(binary_predict.detach().numpy(), labels.to_numpy(), model.cell_anchors.numpy())
+binary_predict = torch.cat(list(model.encode(data.values, batch_size=1024, device='cpu'))).sign()
+labels_pred_CHC, anchor_dists, anchor_margins = annotate_closest_cell_anchor(binary_predict.numpy(), model.cell_anchors.numpy())
 
 string_labels = [label_mapping[str(int_label)] for int_label in labels_pred_CHC]
 
 cell_anchors = model.cell_anchors.numpy()
 num_cell_anchors = len(cell_anchors)
-concated_predict = np.concatenate((binary_predict.detach().numpy(), cell_anchors), axis=0)
+concated_predict = np.concatenate((binary_predict.numpy(), cell_anchors), axis=0)
 
 print("Prediction done!")
 print(binary_predict.shape)